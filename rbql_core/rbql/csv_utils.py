@@ -1,6 +1,11 @@
 from __future__ import unicode_literals
 from __future__ import print_function
+import sys
 import re
+import csv
+
+
+PY3 = sys.version_info[0] == 3
 
 
 newline_rgx = re.compile('(?:\r\n)|\r|\n')
@@ -8,6 +13,9 @@ newline_rgx = re.compile('(?:\r\n)|\r|\n')
 field_regular_expression = '"((?:[^"]*"")*[^"]*)"'
 field_rgx = re.compile(field_regular_expression)
 field_rgx_external_whitespaces = re.compile(' *' + field_regular_expression + ' *')
+field_rgx_external_whitespaces_full = re.compile('^ *' + field_regular_expression + ' *$')
+
+whitespace_field_rgx = re.compile(' *[^ ]+ *')
 
 
 def extract_next_field(src, dlm, preserve_quotes_and_whitespaces, allow_external_whitespaces, cidx, result):
@@ -52,12 +60,70 @@ def split_quoted_str(src, dlm, preserve_quotes_and_whitespaces=False):
     return (result, warning)
 
 
+class CQuotedSplitter(object):
+    # Parser backend for "quoted" and "quoted_rfc" policies which is based on the C reader from the stdlib csv module.
+    # The C reader only handles canonical lines i.e. lines where every field is either unquoted and has no double quotes or is fully enclosed in double quotes without surrounding whitespaces.
+    # Everything else (whitespaces around quoted fields, inconsistent escaping) is delegated to split_quoted_str to keep RBQL semantics and warnings intact.
+    def __init__(self, dlm):
+        assert CQuotedSplitter.supports(dlm)
+        self.dlm = dlm
+        self.pending_line = None
+        self.reader = csv.reader(self, delimiter=dlm, quotechar='"', doublequote=True, skipinitialspace=False, strict=True)
+
+    @staticmethod
+    def supports(dlm):
+        # The csv module in Python 2 doesn't support unicode input.
+        return PY3 and dlm is not None and len(dlm) == 1 and dlm not in ['"', '\r', '\n']
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        # The reader pulls exactly one line per record: an unterminated quoted field triggers an error instead of consuming the next line.
+        line = self.pending_line
+        if line is None:
+            raise StopIteration
+        self.pending_line = None
+        return line
+
+    def split(self, src):
+        if src.find('"') == -1: # Optimization for most common case
+            return (src.split(self.dlm), False)
+        if src[-1] in '\r\n':
+            # The C reader silently drops trailing line terminators.
+            return split_quoted_str(src, self.dlm)
+        self.pending_line = src
+        try:
+            fields = next(self.reader)
+        except (csv.Error, StopIteration):
+            self.pending_line = None
+            return split_quoted_str(src, self.dlm)
+        if ''.join(fields).find('"') != -1 and not self.all_quotes_are_escaped(src, fields):
+            return split_quoted_str(src, self.dlm)
+        return (fields, False)
+
+    def all_quotes_are_escaped(self, src, fields):
+        # A double quote in a value can be either escaped inside a quoted field (valid) or just be a part of an unquoted field (should produce a warning).
+        # In strict mode a field is quoted if and only if it starts with a double quote, so it is enough to walk the raw record once.
+        pos = 0
+        for field in fields:
+            if src.startswith('"', pos):
+                pos += len(field) + field.count('"') + 2
+            elif field.find('"') != -1:
+                return False
+            else:
+                pos += len(field)
+            pos += 1
+        return True
+
+
 def split_whitespace_separated_str(src, preserve_whitespaces=False):
-    rgxp = re.compile(" *[^ ]+ *") if preserve_whitespaces else re.compile("[^ ]+")
+    if not preserve_whitespaces:
+        return [f for f in src.split(' ') if len(f)]
     result = []
-    for m in rgxp.finditer(src):
+    for m in whitespace_field_rgx.finditer(src):
         result.append(m.group())
-    if preserve_whitespaces and len(result) > 1:
+    if len(result) > 1:
         for i in range(len(result) - 1):
             result[i] = result[i][:-1]
     return result
@@ -73,14 +139,38 @@ def smart_split(src, dlm, policy, preserve_quotes_and_whitespaces):
     return split_quoted_str(src, dlm, preserve_quotes_and_whitespaces)
 
 
-def extract_line_from_data(data):
-    mobj = newline_rgx.search(data)
-    if mobj is None:
-        return (None, None, data)
-    pos_start, pos_end = mobj.span()
-    str_before = data[:pos_start]
-    str_after = data[pos_end:]
-    return (str_before, mobj.group(0), str_after)
+def make_splitter(dlm, policy, allow_c_parser=True):
+    # Returns a callable that splits a single record into a (fields, warning) tuple.
+    # Choosing the implementation once per table instead of calling smart_split() for every record saves a chain of policy comparisons and a few nested calls per record.
+    if policy == 'simple':
+        return lambda src: (src.split(dlm), False)
+    if policy == 'whitespace':
+        return lambda src: ([f for f in src.split(' ') if len(f)], False)
+    if policy == 'monocolumn':
+        return lambda src: ([src], False)
+    if allow_c_parser and CQuotedSplitter.supports(dlm):
+        return CQuotedSplitter(dlm).split
+    return lambda src: split_quoted_str(src, dlm)
+
+
+def split_lines_in_bulk(data, final):
+    # Splits a whole block of data into lines at once. Returns (lines, tail, separator) where tail is the incomplete last line that should be prepended to the next block.
+    # A trailing '\r' is kept in the tail when more data is expected, because it can be the first half of a '\r\n' separator.
+    held_cr = ''
+    if not final and len(data) and data[-1] == '\r':
+        data = data[:-1]
+        held_cr = '\r'
+    if data.find('\r') == -1: # Optimization for most common case
+        lines = data.split('\n')
+        separator = '\n' if len(lines) > 1 else None
+    else:
+        lines = newline_rgx.split(data)
+        separator = newline_rgx.search(data).group(0)
+    tail = lines.pop() + held_cr
+    if final and len(tail):
+        lines.append(tail)
+        tail = ''
+    return (lines, tail, separator)
 
 
 def quote_field(src, delim):
@@ -101,7 +191,6 @@ def rfc_quote_field(src, delim):
 
 
 def unquote_field(field):
-    field_rgx_external_whitespaces_full = re.compile('^ *'+ field_regular_expression + ' *$')
     match_obj = field_rgx_external_whitespaces_full.match(field)
     if match_obj is not None:
         return match_obj.group(1).replace('""', '"')
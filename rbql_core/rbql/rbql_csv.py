@@ -6,6 +6,10 @@ import sys
 import os
 import codecs
 import io
+import mmap
+import stat
+import shutil
+import tempfile
 from errno import EPIPE
 
 from . import rbql_engine
@@ -16,6 +20,10 @@ PY3 = sys.version_info[0] == 3
 polymorphic_xrange = range if PY3 else xrange
 
 default_csv_encoding = 'utf-8'
+default_max_chunk_size = 1024 * 1024
+min_parallel_part_size = 1024 * 1024
+parallel_parts_per_worker = 4
+output_buffer_size = 1024 * 1024 # Max number of characters accumulated in CSVWriter before writing them to a file
 ansi_reset_color_code = '\u001b[0m'
 
 debug_mode = False
@@ -72,6 +80,80 @@ def encode_input_stream(stream, encoding):
         return codecs.getreader(encoding)(stream)
 
 
+compression_magic_numbers = [(b'\x1f\x8b', 'gzip'), (b'BZh', 'bz2'), (b'\xfd7zXZ\x00', 'xz')]
+compression_extensions = [('.gz', 'gzip'), ('.bz2', 'bz2'), ('.xz', 'xz')]
+
+
+def detect_file_compression(path):
+    with open(path, 'rb') as src:
+        header = src.read(6)
+    for magic_number, compression in compression_magic_numbers:
+        if header.startswith(magic_number):
+            return compression
+    return None
+
+
+def get_compression_by_extension(path):
+    for extension, compression in compression_extensions:
+        if path.lower().endswith(extension):
+            return compression
+    return None
+
+
+def strip_compression_extension(path):
+    if get_compression_by_extension(path) is None:
+        return path
+    return os.path.splitext(path)[0]
+
+
+def open_compressed_file(path, compression, mode):
+    # Compression modules are imported lazily because some Python builds come without them, e.g. lzma is missing in Python 2.
+    try:
+        if compression == 'gzip':
+            import gzip
+            return gzip.open(path, mode, compresslevel=6) # Default level 9 is several times slower and only marginally better for CSV data
+        if compression == 'bz2':
+            import bz2
+            return bz2.BZ2File(path, mode)
+        import lzma
+        return lzma.open(path, mode)
+    except ImportError:
+        raise rbql_engine.RbqlIOHandlingError('Unable to open "{}": {} compression is not supported by this Python installation'.format(path, compression))
+
+
+def open_input_file(path):
+    # Returns (stream, is_compressed) tuple. Compressed files are detected by magic bytes and are decompressed on the fly.
+    compression = detect_file_compression(path)
+    if compression is None:
+        return (open(path, 'rb'), False)
+    return (open_compressed_file(path, compression, 'rb'), True)
+
+
+def open_output_file(path):
+    # Output is compressed on the fly if the file has .gz, .bz2 or .xz extension.
+    compression = get_compression_by_extension(path)
+    if compression is None:
+        return open(path, 'wb')
+    return open_compressed_file(path, compression, 'wb')
+
+
+def get_output_stream_kind(stream):
+    # Returns 'tty', 'pipe' or 'file'. Streams without a file descriptor (e.g. BytesIO) are treated as files.
+    try:
+        if stream.isatty():
+            return 'tty'
+        if stat.S_ISFIFO(os.fstat(stream.fileno()).st_mode):
+            return 'pipe'
+    except Exception:
+        pass
+    return 'file'
+
+
+def get_binary_stream(stream):
+    # sys.stdin and sys.stdout are text streams wrapping a binary buffer, files opened in 'rb'/'wb' mode and BytesIO are binary already
+    return getattr(stream, 'buffer', stream)
+
+
 def encode_output_stream(stream, encoding):
     if encoding is None:
         return stream
@@ -145,6 +227,17 @@ def make_inconsistent_num_fields_warning(table_name, inconsistent_records_info):
     return warn_msg
 
 
+def make_input_table_warnings(table_name, utf8_bom_removed, first_defective_line, fields_info):
+    result = list()
+    if utf8_bom_removed:
+        result.append('UTF-8 Byte Order Mark (BOM) was found and skipped in {} table'.format(table_name))
+    if first_defective_line is not None:
+        result.append('Inconsistent double quote escaping in {} table. E.g. at line {}'.format(table_name, first_defective_line))
+    if len(fields_info) > 1:
+        result.append(make_inconsistent_num_fields_warning(table_name, fields_info))
+    return result
+
+
 def init_ansi_terminal_colors():
     result = [ansi_reset_color_code]
     foreground_codes = list(range(31, 37 + 1))
@@ -165,25 +258,39 @@ def init_ansi_terminal_colors():
 class CSVWriter(rbql_engine.RBQLOutputWriter):
     def __init__(self, stream, close_stream_on_finish, encoding, delim, policy, line_separator='\n', colorize_output=False):
         assert encoding in ['utf-8', 'latin-1', None]
-        self.stream = encode_output_stream(stream, encoding)
+        self.output_encoding = None
+        if PY3 and encoding is not None and os.linesep == '\n':
+            # Each batch of output lines is encoded with a single call and written directly to the binary stream.
+            # TextIOWrapper is still used on systems where it would translate '\n' into a different line separator.
+            if stream is not get_binary_stream(stream):
+                stream.flush()
+            self.stream = get_binary_stream(stream)
+            self.output_encoding = encoding
+        else:
+            self.stream = encode_output_stream(stream, encoding)
         self.line_separator = line_separator
         self.delim = delim
         self.sub_array_delim = '|' if delim != '|' else ';'
         self.broken_pipe = False
         self.close_stream_on_finish = close_stream_on_finish
         self.polymorphic_preprocess = None
-        self.polymorphic_join = self.join_by_delim 
-        self.check_separators_after_join = False
+        self.polymorphic_join = self.join_by_delim
         self.colors = None
         if policy == 'simple' or policy == 'whitespace':
             if colorize_output:
                 self.polymorphic_preprocess = self.check_separators_in_fields_before_join
             else:
-                self.check_separators_after_join = True
+                self.polymorphic_join = self.join_by_delim_checked
         elif policy == 'quoted':
-            self.polymorphic_preprocess = self.quote_fields
+            if colorize_output:
+                self.polymorphic_preprocess = self.quote_fields
+            else:
+                self.polymorphic_join = self.join_quoted
         elif policy == 'quoted_rfc':
-            self.polymorphic_preprocess = self.quote_fields_rfc
+            if colorize_output:
+                self.polymorphic_preprocess = self.quote_fields_rfc
+            else:
+                self.polymorphic_join = self.join_quoted_rfc
         elif policy == 'monocolumn':
             colorize_output = False
             self.polymorphic_preprocess = self.ensure_single_field
@@ -197,6 +304,12 @@ class CSVWriter(rbql_engine.RBQLOutputWriter):
         self.none_in_output = False
         self.delim_in_simple_output = False
         self.header_len = None
+        self.pending_lines = []
+        self.pending_size = 0
+        # Terminal output is flushed after every line. Pipe output starts with single lines and the flush threshold doubles after each flush:
+        # this way consumers like `head -n 10` get the first lines (and close the pipe) right away, while long streams are still written in large blocks.
+        self.stream_kind = get_output_stream_kind(self.stream)
+        self.flush_threshold = output_buffer_size if self.stream_kind == 'file' else 1
 
 
     def set_header(self, header):
@@ -214,13 +327,37 @@ class CSVWriter(rbql_engine.RBQLOutputWriter):
             self.delim_in_simple_output = True
 
 
-    def check_separator_in_fields_after_join(self, output_line, num_fields_expected):
-        num_fields_calculated = output_line.count(self.delim) + 1
-        if num_fields_calculated != num_fields_expected:
+    def join_by_delim(self, fields):
+        return self.delim.join(fields)
+
+
+    def join_by_delim_checked(self, fields):
+        out_line = self.delim.join(fields)
+        # A record without fields is joined into an empty line without separators, so the count check doesn't apply to it
+        if len(fields) and out_line.count(self.delim) + 1 != len(fields):
             self.delim_in_simple_output = True
+        return out_line
+
+
+    def join_quoted(self, fields):
+        # Checking the joined line takes a few C-level scans per record instead of several scans per field.
+        # If the line has no double quotes and the expected number of separators then none of the fields need quoting.
+        out_line = self.delim.join(fields)
+        if not len(fields):
+            return out_line
+        if out_line.find('"') == -1 and out_line.count(self.delim) + 1 == len(fields):
+            return out_line
+        self.quote_fields(fields)
+        return self.delim.join(fields)
 
 
-    def join_by_delim(self, fields):
+    def join_quoted_rfc(self, fields):
+        out_line = self.delim.join(fields)
+        if not len(fields):
+            return out_line
+        if out_line.find('"') == -1 and out_line.find('\n') == -1 and out_line.find('\r') == -1 and out_line.count(self.delim) + 1 == len(fields):
+            return out_line
+        self.quote_fields_rfc(fields)
         return self.delim.join(fields)
 
 
@@ -237,14 +374,30 @@ class CSVWriter(rbql_engine.RBQLOutputWriter):
 
         out_line = self.polymorphic_join(fields)
 
-        if self.check_separators_after_join:
-            self.check_separator_in_fields_after_join(out_line, len(fields))
+        if self.colors is not None:
+            out_line += ansi_reset_color_code
+        self.pending_lines.append(out_line)
+        self.pending_size += len(out_line)
+        if self.pending_size >= self.flush_threshold:
+            return self.flush_pending_lines()
+        return True
 
+
+    def flush_pending_lines(self):
+        if not len(self.pending_lines):
+            return True
+        pending_lines = self.pending_lines
+        self.pending_lines = []
+        self.pending_size = 0
+        output_data = self.line_separator.join(pending_lines) + self.line_separator
+        if self.output_encoding is not None:
+            output_data = output_data.encode(self.output_encoding)
         try:
-            self.stream.write(out_line)
-            if self.colors is not None:
-                self.stream.write(ansi_reset_color_code)
-            self.stream.write(self.line_separator)
+            self.stream.write(output_data)
+            if self.stream_kind != 'file':
+                self.stream.flush()
+                if self.stream_kind == 'pipe':
+                    self.flush_threshold = min(self.flush_threshold * 2, output_buffer_size)
             return True
         except broken_pipe_exception as exc:
             if broken_pipe_exception == IOError:
@@ -299,6 +452,8 @@ class CSVWriter(rbql_engine.RBQLOutputWriter):
     def finish(self):
         if self.broken_pipe:
             return
+        if not self.flush_pending_lines():
+            return
         if self.close_stream_on_finish:
             self.stream.close()
         else:
@@ -328,28 +483,199 @@ class CSVWriter(rbql_engine.RBQLOutputWriter):
         return result
 
 
+class BytesLineReader(object):
+    # Reads raw bytes from a binary stream (e.g. a pipe) and decodes each block of complete lines with a single call, bypassing the TextIOWrapper layer.
+    # Blocks are cut right after a newline byte, so a multibyte UTF-8 character is never split between two blocks.
+    def __init__(self, stream, encoding, chunk_size=1024, max_chunk_size=None):
+        self.stream = stream
+        self.encoding = encoding
+        self.chunk_size = chunk_size
+        self.max_chunk_size = max(chunk_size, max_chunk_size if max_chunk_size is not None else default_max_chunk_size)
+        self.lines = []
+        self.cursor = 0
+        self.tail = b'' # Bytes after the last newline in the previous block
+        self.text_tail = '' # Trailing '\r' that can be the first half of a '\r\n' separator
+        self.exhausted = False
+        self.detected_line_separator = '\n'
+
+
+    def _read_block(self):
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self.exhausted = True
+            self.lines, _tail, _separator = csv_utils.split_lines_in_bulk(self.text_tail + self.tail.decode(self.encoding), final=True)
+        else:
+            data = self.tail + chunk if len(self.tail) else chunk
+            cut = data.rfind(b'\n')
+            if cut == -1:
+                cut = data.rfind(b'\r')
+            self.tail = data[cut + 1:]
+            text = data[:cut + 1].decode(self.encoding)
+            if len(self.text_tail):
+                text = self.text_tail + text
+            self.lines, self.text_tail, separator = csv_utils.split_lines_in_bulk(text, final=False)
+            if separator is not None:
+                self.detected_line_separator = separator
+            self.chunk_size = min(self.chunk_size * 2, self.max_chunk_size)
+        self.cursor = 0
+
+
+    def read_line(self):
+        while self.cursor >= len(self.lines):
+            if self.exhausted:
+                return None
+            self._read_block()
+        line = self.lines[self.cursor]
+        self.cursor += 1
+        return line
+
+
+class BufferedLineReader(object):
+    # Reads the stream in large blocks and splits every block into lines in bulk. A cursor into the list of ready lines is used instead of re-slicing the buffer for each row.
+    # The block size starts from chunk_size (to return the first lines quickly) and is doubled after each read until it reaches max_chunk_size.
+    def __init__(self, stream, chunk_size=1024, max_chunk_size=None):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.max_chunk_size = max(chunk_size, max_chunk_size if max_chunk_size is not None else default_max_chunk_size)
+        self.lines = []
+        self.cursor = 0
+        self.tail = ''
+        self.exhausted = False
+        self.detected_line_separator = '\n'
+
+
+    def _read_block(self):
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self.exhausted = True
+            self.lines, self.tail, _separator = csv_utils.split_lines_in_bulk(self.tail, final=True)
+        else:
+            data = self.tail + chunk if len(self.tail) else chunk
+            self.lines, self.tail, separator = csv_utils.split_lines_in_bulk(data, final=False)
+            if separator is not None:
+                self.detected_line_separator = separator
+            self.chunk_size = min(self.chunk_size * 2, self.max_chunk_size)
+        self.cursor = 0
+
+
+    def read_line(self):
+        while self.cursor >= len(self.lines):
+            if self.exhausted:
+                return None
+            self._read_block()
+        line = self.lines[self.cursor]
+        self.cursor += 1
+        return line
+
+
+def is_mappable_file(stream):
+    try:
+        return stat.S_ISREG(os.fstat(stream.fileno()).st_mode)
+    except Exception:
+        return False
+
+
+class MmapLineReader(object):
+    # Reads lines directly from a memory-mapped file, bypassing the TextIOWrapper layer: newlines are located on the mapped bytes and each block of complete lines is decoded with a single call.
+    # Decoding the whole block at once is cheaper than decoding individual fields, and cutting the block at a newline byte never splits a multibyte UTF-8 character.
+    # start_offset and end_offset allow reading any line-aligned byte range of the file.
+    def __init__(self, stream, encoding, start_offset=0, end_offset=None, block_size=None):
+        self.encoding = encoding
+        fileno = stream.fileno()
+        file_size = os.fstat(fileno).st_size
+        self.end_offset = file_size if end_offset is None else min(end_offset, file_size)
+        self.pos = start_offset
+        self.block_size = block_size if block_size is not None else default_max_chunk_size
+        self.lines = []
+        self.cursor = 0
+        self.detected_line_separator = '\n'
+        self.exhausted = self.pos >= self.end_offset
+        self.mapped = None
+        if self.exhausted:
+            return
+        self.mapped = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+        if hasattr(self.mapped, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            self.mapped.madvise(mmap.MADV_SEQUENTIAL)
+        if hasattr(os, 'posix_fadvise') and hasattr(os, 'POSIX_FADV_SEQUENTIAL'):
+            os.posix_fadvise(fileno, self.pos, self.end_offset - self.pos, os.POSIX_FADV_SEQUENTIAL)
+
+
+    def _find_block_end(self):
+        block_end = min(self.pos + self.block_size, self.end_offset)
+        while block_end < self.end_offset:
+            cut = self.mapped.rfind(b'\n', self.pos, block_end)
+            if cut == -1:
+                cut = self.mapped.rfind(b'\r', self.pos, block_end)
+                if cut != -1 and self.mapped[cut + 1:cut + 2] == b'\n':
+                    cut += 1
+            if cut != -1:
+                return min(cut + 1, self.end_offset)
+            block_end = min(block_end + self.block_size, self.end_offset) # The current line is longer than the block
+        return self.end_offset
+
+
+    def _read_block(self):
+        block_end = self._find_block_end()
+        data = self.mapped[self.pos:block_end].decode(self.encoding)
+        self.pos = block_end
+        self.lines, _tail, separator = csv_utils.split_lines_in_bulk(data, final=True)
+        if separator is not None:
+            self.detected_line_separator = separator
+        self.cursor = 0
+        if self.pos >= self.end_offset:
+            self.close()
+
+
+    def read_line(self):
+        while self.cursor >= len(self.lines):
+            if self.exhausted:
+                return None
+            self._read_block()
+        line = self.lines[self.cursor]
+        self.cursor += 1
+        return line
+
+
+    def close(self):
+        self.exhausted = True
+        if self.mapped is not None:
+            self.mapped.close()
+            self.mapped = None
+
+
 class CSVRecordIterator(rbql_engine.RBQLInputIterator):
-    def __init__(self, stream, encoding, delim, policy, has_header=False, comment_prefix=None, table_name='input', variable_prefix='a', chunk_size=1024, line_mode=False):
+    def __init__(self, stream, encoding, delim, policy, has_header=False, comment_prefix=None, table_name='input', variable_prefix='a', chunk_size=1024, line_mode=False, use_mmap=False, parser_backend='auto', byte_range=None):
+        # byte_range is a (start_offset, end_offset) tuple of a record-aligned part of a memory-mappable file, see split_file_into_parts()
         assert encoding in ['utf-8', 'latin-1', None]
+        assert parser_backend in ['auto', 'python']
         self.encoding = encoding
-        self.stream = encode_input_stream(stream, encoding)
+        self.is_table_start = byte_range is None or byte_range[0] == 0
+        if byte_range is not None:
+            self.stream = stream
+            self.line_reader = MmapLineReader(stream, encoding, start_offset=byte_range[0], end_offset=byte_range[1])
+        elif use_mmap and encoding is not None and is_mappable_file(stream):
+            self.stream = stream
+            self.line_reader = MmapLineReader(stream, encoding)
+        elif PY3 and encoding is not None:
+            self.stream = get_binary_stream(stream)
+            self.line_reader = BytesLineReader(self.stream, encoding, chunk_size)
+        else:
+            self.stream = encode_input_stream(stream, encoding)
+            self.line_reader = BufferedLineReader(self.stream, chunk_size)
         self.delim = delim
         self.policy = policy
         self.table_name = table_name
         self.variable_prefix = variable_prefix
         self.comment_prefix = comment_prefix if (comment_prefix is not None and len(comment_prefix)) else None
 
-        self.buffer = ''
-        self.detected_line_separator = '\n'
-        self.exhausted = False
         self.NR = 0 # Record number
         self.NL = 0 # Line number (NL != NR when the CSV file has comments or multiline fields)
-        self.chunk_size = chunk_size
         self.fields_info = dict()
 
         self.utf8_bom_removed = False
         self.first_defective_line = None
         self.polymorphic_get_row = self.get_row_rfc if policy == 'quoted_rfc' else self.get_row_simple
+        self.polymorphic_split = csv_utils.make_splitter(delim, policy, allow_c_parser=(parser_backend == 'auto'))
         self.has_header = has_header
         self.first_record_should_be_emitted = False
 
@@ -381,57 +707,20 @@ class CSVRecordIterator(rbql_engine.RBQLInputIterator):
     def get_header(self):
         return self.first_record if self.has_header else None
 
-    def _get_row_from_buffer(self):
-        str_before, separator, str_after = csv_utils.extract_line_from_data(self.buffer)
-        if separator is None:
-            return None
-        if separator == '\r' and str_after == '':
-            one_more = self.stream.read(1)
-            if one_more == '\n':
-                separator = '\r\n'
-            else:
-                str_after = one_more
-        self.detected_line_separator = separator
-        self.buffer = str_after
-        return str_before
-
-
-    def _read_until_found(self):
-        if self.exhausted:
-            return
-        chunks = []
-        while True:
-            chunk = self.stream.read(self.chunk_size)
-            if not chunk:
-                self.exhausted = True
-                break
-            chunks.append(chunk)
-            if csv_utils.newline_rgx.search(chunk) is not None:
-                break
-        self.buffer += ''.join(chunks)
-
-
     def get_row_simple(self):
         try:
-            row = self._get_row_from_buffer()
-            if row is None:
-                self._read_until_found()
-                row = self._get_row_from_buffer()
-                if row is None:
-                    assert self.exhausted
-                    if not len(self.buffer):
-                        return None
-                    row = self.buffer
-                    self.buffer = ''
-            self.NL += 1
-            if self.NL == 1:
-                clean_line = remove_utf8_bom(row, self.encoding)
-                if clean_line != row:
-                    row = clean_line
-                    self.utf8_bom_removed = True
-            return row
+            row = self.line_reader.read_line()
         except UnicodeDecodeError:
             raise rbql_engine.RbqlIOHandlingError('Unable to decode input table as UTF-8. Use binary (latin-1) encoding instead')
+        if row is None:
+            return None
+        self.NL += 1
+        if self.NL == 1 and self.is_table_start:
+            clean_line = remove_utf8_bom(row, self.encoding)
+            if clean_line != row:
+                row = clean_line
+                self.utf8_bom_removed = True
+        return row
 
     
     def get_row_rfc(self):
@@ -453,26 +742,40 @@ class CSVRecordIterator(rbql_engine.RBQLInputIterator):
 
 
     def get_record(self):
+        records = self.get_records(1)
+        return records[0] if records else None
+
+
+    def get_records(self, max_records):
+        result = []
         if self.first_record_should_be_emitted:
             self.first_record_should_be_emitted = False
-            return self.first_record
-        while True:
-            line = self.polymorphic_get_row()
+            if self.first_record is not None: # The input is empty or has only comment lines
+                result.append(self.first_record)
+        # Local bindings to avoid attribute lookups in the per-record loop
+        get_row = self.polymorphic_get_row
+        comment_prefix = self.comment_prefix
+        split_record = self.polymorphic_split
+        policy = self.policy
+        fields_info = self.fields_info
+        while len(result) < max_records:
+            line = get_row()
             if line is None:
-                return None
-            if self.comment_prefix is None or not line.startswith(self.comment_prefix):
                 break
-        self.NR += 1
-        record, warning = csv_utils.smart_split(line, self.delim, self.policy, preserve_quotes_and_whitespaces=False)
-        if warning:
-            if self.first_defective_line is None:
-                self.first_defective_line = self.NL
-                if self.policy == 'quoted_rfc':
-                    raise rbql_engine.RbqlIOHandlingError('Inconsistent double quote escaping in {} table at record {}, line {}'.format(self.table_name, self.NR, self.NL))
-        num_fields = len(record)
-        if num_fields not in self.fields_info:
-            self.fields_info[num_fields] = self.NR
-        return record
+            if comment_prefix is not None and line.startswith(comment_prefix):
+                continue
+            self.NR += 1
+            record, warning = split_record(line)
+            if warning:
+                if self.first_defective_line is None:
+                    self.first_defective_line = self.NL
+                    if policy == 'quoted_rfc':
+                        raise rbql_engine.RbqlIOHandlingError('Inconsistent double quote escaping in {} table at record {}, line {}'.format(self.table_name, self.NR, self.NL))
+            num_fields = len(record)
+            if num_fields not in fields_info:
+                fields_info[num_fields] = self.NR
+            result.append(record)
+        return result
 
 
     def _get_all_rows(self):
@@ -487,25 +790,17 @@ class CSVRecordIterator(rbql_engine.RBQLInputIterator):
 
     def get_all_records(self, num_rows=None):
         result = []
-        while True:
-            record = self.get_record()
-            if record is None:
-                break
-            result.append(record)
-            if num_rows is not None and len(result) >= num_rows:
+        while num_rows is None or len(result) < num_rows:
+            batch_size = rbql_engine.input_batch_size if num_rows is None else min(rbql_engine.input_batch_size, num_rows - len(result))
+            records_batch = self.get_records(batch_size)
+            if not records_batch:
                 break
+            result.extend(records_batch)
         return result
 
 
     def get_warnings(self):
-        result = list()
-        if self.utf8_bom_removed:
-            result.append('UTF-8 Byte Order Mark (BOM) was found and skipped in {} table'.format(self.table_name))
-        if self.first_defective_line is not None:
-            result.append('Inconsistent double quote escaping in {} table. E.g. at line {}'.format(self.table_name, self.first_defective_line))
-        if len(self.fields_info) > 1:
-            result.append(make_inconsistent_num_fields_warning(self.table_name, self.fields_info))
-        return result
+        return make_input_table_warnings(self.table_name, self.utf8_bom_removed, self.first_defective_line, self.fields_info)
 
 
 class FileSystemCSVRegistry(rbql_engine.RBQLTableRegistry):
@@ -524,8 +819,8 @@ class FileSystemCSVRegistry(rbql_engine.RBQLTableRegistry):
         self.table_path = find_table_path(self.input_file_dir, table_id)
         if self.table_path is None:
             raise rbql_engine.RbqlIOHandlingError('Unable to find join table "{}"'.format(table_id))
-        self.input_stream = open(self.table_path, 'rb')
-        self.record_iterator = CSVRecordIterator(self.input_stream, self.encoding, self.delim, self.policy, self.has_header, comment_prefix=self.comment_prefix, table_name=table_id, variable_prefix=single_char_alias)
+        self.input_stream, is_compressed = open_input_file(self.table_path)
+        self.record_iterator = CSVRecordIterator(self.input_stream, self.encoding, self.delim, self.policy, self.has_header, comment_prefix=self.comment_prefix, table_name=table_id, variable_prefix=single_char_alias, use_mmap=not is_compressed)
         return self.record_iterator
 
     def finish(self):
@@ -539,13 +834,272 @@ class FileSystemCSVRegistry(rbql_engine.RBQLTableRegistry):
         return result
 
 
-def query_csv(query_text, input_path, input_delim, input_policy, output_path, output_delim, output_policy, csv_encoding, output_warnings, with_headers, comment_prefix=None, user_init_code='', colorize_output=False):
+def count_bytes(mapped, needle, start_offset, end_offset):
+    # Counts in blocks to avoid copying a large part of the mapped file at once
+    result = 0
+    while start_offset < end_offset:
+        block_end = min(start_offset + default_max_chunk_size * 16, end_offset)
+        result += mapped[start_offset:block_end].count(needle)
+        start_offset = block_end
+    return result
+
+
+def split_file_into_parts(input_path, num_parts, policy):
+    # Returns a list of (start_offset, end_offset) byte ranges of roughly equal size, every range starts at the beginning of a record.
+    # With "quoted_rfc" policy a record can span multiple lines: a line starts a new record only if the number of double quotes before it is even.
+    with open(input_path, 'rb') as src:
+        file_size = os.fstat(src.fileno()).st_size
+        if file_size == 0:
+            return [(0, 0)]
+        mapped = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            boundaries = [0]
+            pos = 0
+            quotes_parity = 0
+            for part_index in polymorphic_xrange(1, num_parts):
+                target = file_size * part_index // num_parts
+                if target <= pos:
+                    continue
+                if policy == 'quoted_rfc':
+                    quotes_parity ^= count_bytes(mapped, b'"', pos, target) % 2
+                pos = target
+                while pos < file_size:
+                    newline_pos = mapped.find(b'\n', pos)
+                    if newline_pos == -1:
+                        pos = file_size
+                        break
+                    if policy == 'quoted_rfc':
+                        quotes_parity ^= count_bytes(mapped, b'"', pos, newline_pos + 1) % 2
+                    pos = newline_pos + 1
+                    if quotes_parity == 0:
+                        break
+                if pos >= file_size:
+                    break
+                boundaries.append(pos)
+            boundaries.append(file_size)
+        finally:
+            mapped.close()
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+class TablePartIterator(rbql_engine.RBQLInputIterator):
+    # Input iterator for a single part of the input table in parallel mode.
+    # The header and query modifiers are handled by the main process and input warnings are merged there as well.
+    def __init__(self, record_iterator, header, records_offset):
+        self.record_iterator = record_iterator
+        self.header = header
+        self.records_offset = records_offset
+
+    def get_variables_map(self, query_text):
+        variable_map = dict()
+        rbql_engine.parse_basic_variables(query_text, 'a', variable_map)
+        rbql_engine.parse_array_variables(query_text, 'a', variable_map)
+        if self.header is not None:
+            rbql_engine.parse_attribute_variables(query_text, 'a', self.header, 'CSV header line', variable_map)
+            rbql_engine.parse_dictionary_variables(query_text, 'a', self.header, variable_map)
+        return variable_map
+
+    def get_header(self):
+        return self.header
+
+    def get_record(self):
+        return self.record_iterator.get_record()
+
+    def get_records(self, max_records):
+        return self.record_iterator.get_records(max_records)
+
+    def get_records_offset(self):
+        return self.records_offset
+
+
+class TablePartWriter(rbql_engine.RBQLOutputWriter):
+    # Only the writer of the first part outputs the header, but all of them check the number of output columns against it
+    def __init__(self, subwriter, write_header):
+        self.subwriter = subwriter
+        self.write_header = write_header
+
+    def set_header(self, header):
+        if self.write_header:
+            self.subwriter.set_header(header)
+        elif header is not None:
+            self.subwriter.header_len = len(header)
+
+    def write(self, fields):
+        return self.subwriter.write(fields)
+
+    def finish(self):
+        self.subwriter.finish()
+
+    def get_warnings(self):
+        return self.subwriter.get_warnings()
+
+
+def count_records_in_table_part(input_path, encoding, policy, comment_prefix, byte_range):
+    with open(input_path, 'rb') as input_stream:
+        record_iterator = CSVRecordIterator(input_stream, encoding, None, policy, comment_prefix=comment_prefix, line_mode=True, byte_range=byte_range)
+        num_records = 0
+        while True:
+            row = record_iterator.polymorphic_get_row()
+            if row is None:
+                break
+            if record_iterator.comment_prefix is None or not row.startswith(record_iterator.comment_prefix):
+                num_records += 1
+        return num_records
+
+
+def query_csv_table_part(query_text, input_path, delim, policy, encoding, header, with_headers, comment_prefix, user_init_code, byte_range, records_offset, output_path, output_delim, output_policy, colorize_output):
+    # Runs in a worker process. Returns statistics of the input table part which are needed to produce input warnings with global record and line numbers.
+    # If output_path is None the query is executed with rbql_engine.query_partial() and its partial result is returned as well.
+    join_tables_registry = FileSystemCSVRegistry(os.path.dirname(input_path), delim, policy, encoding, with_headers, comment_prefix)
+    warnings = []
+    partial_result = None
+    try:
+        with open(input_path, 'rb') as input_stream:
+            is_first_part = byte_range[0] == 0
+            record_iterator = CSVRecordIterator(input_stream, encoding, delim, policy, has_header=(is_first_part and header is not None), comment_prefix=comment_prefix, byte_range=byte_range)
+            input_iterator = TablePartIterator(record_iterator, header, records_offset)
+            if output_path is None:
+                partial_result = rbql_engine.query_partial(query_text, input_iterator, warnings, join_tables_registry, user_init_code)
+            else:
+                with open(output_path, 'wb') as output_stream:
+                    output_writer = TablePartWriter(CSVWriter(output_stream, False, encoding, output_delim, output_policy, colorize_output=colorize_output), is_first_part)
+                    rbql_engine.query(query_text, input_iterator, output_writer, warnings, join_tables_registry, user_init_code)
+    finally:
+        join_tables_registry.finish()
+    warnings += join_tables_registry.get_warnings()
+    return (record_iterator.NR, record_iterator.NL, record_iterator.fields_info, record_iterator.first_defective_line, record_iterator.utf8_bom_removed, warnings, partial_result)
+
+
+def try_query_csv_in_parallel(num_workers, query_text, input_path, input_delim, input_policy, output_stream, output_delim, output_policy, csv_encoding, output_warnings, with_headers, comment_prefix, user_init_code, colorize_output):
+    # Splits the input file into record-aligned parts and runs the query on every part in a process pool, part outputs are concatenated in the input order.
+    # Aggregate and DISTINCT queries return partial results instead, which are merged by the main process.
+    # Returns False if the query should be executed by the regular single-process code instead: if the query or the table is not suitable or if any of the workers has failed with a query error.
+    # In the latter case the regular execution reports the error with exact record and line numbers. Other exceptions are propagated.
+    query_info = rbql_engine.get_parallel_query_info(query_text)
+    if query_info is None or not os.path.isfile(input_path):
+        return False
+    if detect_file_compression(input_path) is not None:
+        return False # Compressed streams can't be split into parts without decompressing them
+    if input_policy == 'quoted_rfc' and comment_prefix is not None:
+        return False # Comment lines can contain unbalanced double quotes which makes it impossible to find record boundaries without parsing the whole file
+    num_parts = min(num_workers * parallel_parts_per_worker, os.path.getsize(input_path) // min_parallel_part_size)
+    if num_parts < 2:
+        return False
+    byte_ranges = split_file_into_parts(input_path, num_parts, input_policy)
+    if len(byte_ranges) < 2:
+        return False
+
+    has_header = with_headers
+    for modifier in query_info['query_modifiers']:
+        if modifier in ['header', 'headers']:
+            has_header = True
+        if modifier in ['noheader', 'noheaders']:
+            has_header = False
+    header = None
+    if has_header:
+        with open(input_path, 'rb') as input_stream:
+            header = CSVRecordIterator(input_stream, csv_encoding, input_delim, input_policy, has_header=True, comment_prefix=comment_prefix, byte_range=byte_ranges[0]).get_header()
+        if header is None:
+            return False
+
+    import multiprocessing
+    tmp_dir = tempfile.mkdtemp(prefix='rbql_parallel_')
+    try:
+        pool = multiprocessing.Pool(num_workers)
+        async_results = []
+        try:
+            records_offsets = [0] * len(byte_ranges)
+            if query_info['uses_record_number']:
+                # NR must have its global meaning, so we need to know the number of records in all preceding parts beforehand
+                count_results = [pool.apply_async(count_records_in_table_part, (input_path, csv_encoding, input_policy, comment_prefix, byte_range)) for byte_range in byte_ranges]
+                async_results += count_results
+                num_records_before = 0
+                for part_index, count_result in enumerate(count_results):
+                    records_offsets[part_index] = num_records_before - 1 if (header is not None and part_index > 0) else num_records_before
+                    num_records_before += count_result.get()
+            if query_info['merge_results']:
+                part_output_paths = [None] * len(byte_ranges)
+            else:
+                part_output_paths = [os.path.join(tmp_dir, 'part_{}'.format(part_index)) for part_index in polymorphic_xrange(len(byte_ranges))]
+            part_results = []
+            for part_index, byte_range in enumerate(byte_ranges):
+                task_args = (query_text, input_path, input_delim, input_policy, csv_encoding, header, with_headers, comment_prefix, user_init_code, byte_range, records_offsets[part_index], part_output_paths[part_index], output_delim, output_policy, colorize_output)
+                part_results.append(pool.apply_async(query_csv_table_part, task_args))
+            async_results += part_results
+            part_stats = [part_result.get() for part_result in part_results]
+            merged_result = None
+            if query_info['merge_results']:
+                # Merging can fail e.g. on non-constant values in a GROUP BY output column from different parts, the regular execution reports such errors with the first conflicting record
+                merged_result = rbql_engine.merge_partial_results([stats[-1] for stats in part_stats])
+        except (rbql_engine.RbqlRuntimeError, rbql_engine.RbqlParsingError, rbql_engine.RbqlIOHandlingError):
+            if debug_mode:
+                raise
+            return False
+        finally:
+            # Pool.terminate() can deadlock if the pool is still dispatching tasks, so we let the remaining tasks finish instead
+            for async_result in async_results:
+                async_result.wait()
+            pool.close()
+            pool.join()
+
+        num_records_before = 0
+        num_lines_before = 0
+        fields_info = dict()
+        first_defective_line = None
+        utf8_bom_removed = False
+        part_warnings = []
+        for num_records, num_lines, part_fields_info, part_first_defective_line, part_utf8_bom_removed, warnings, _partial_result in part_stats:
+            for num_fields, record_num in part_fields_info.items():
+                if num_fields not in fields_info:
+                    fields_info[num_fields] = num_records_before + record_num
+            if first_defective_line is None and part_first_defective_line is not None:
+                first_defective_line = num_lines_before + part_first_defective_line
+            utf8_bom_removed = utf8_bom_removed or part_utf8_bom_removed
+            part_warnings += warnings
+            num_records_before += num_records
+            num_lines_before += num_lines
+        output_warnings += make_input_table_warnings('input', utf8_bom_removed, first_defective_line, fields_info)
+        for warning in part_warnings:
+            if warning not in output_warnings:
+                output_warnings.append(warning)
+
+        if merged_result is not None:
+            output_writer = CSVWriter(output_stream, False, csv_encoding, output_delim, output_policy, colorize_output=colorize_output)
+            rbql_engine.write_partial_result(merged_result, output_writer)
+            output_warnings += output_writer.get_warnings()
+            return True
+
+        binary_output_stream = get_binary_stream(output_stream)
+        if binary_output_stream is not output_stream:
+            output_stream.flush()
+        try:
+            for part_output_path in part_output_paths:
+                with open(part_output_path, 'rb') as part_output:
+                    shutil.copyfileobj(part_output, binary_output_stream, default_max_chunk_size)
+            binary_output_stream.flush()
+        except broken_pipe_exception as exc:
+            if broken_pipe_exception == IOError:
+                if exc.errno != EPIPE:
+                    raise
+            try:
+                sys.stdout.close() # See the explanation in CSVWriter.finish()
+            except (IOError, OSError):
+                pass
+        return True
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def query_csv(query_text, input_path, input_delim, input_policy, output_path, output_delim, output_policy, csv_encoding, output_warnings, with_headers, comment_prefix=None, user_init_code='', colorize_output=False, pipelined=False, num_workers=1):
     output_stream, close_output_on_finish = (None, False)
     input_stream, close_input_on_finish = (None, False)
     join_tables_registry = None
     try:
-        output_stream, close_output_on_finish = (sys.stdout, False) if output_path is None else (open(output_path, 'wb'), True)
-        input_stream, close_input_on_finish = (sys.stdin, False) if input_path is None else (open(input_path, 'rb'), True)
+        output_stream, close_output_on_finish = (sys.stdout, False) if output_path is None else (open_output_file(output_path), True)
+        input_stream, close_input_on_finish, input_is_compressed = (sys.stdin, False, False)
+        if input_path is not None:
+            input_stream, input_is_compressed = open_input_file(input_path)
+            close_input_on_finish = True
 
         if input_delim == '"' and input_policy == 'quoted':
             raise rbql_engine.RbqlIOHandlingError('Double quote delimiter is incompatible with "quoted" policy')
@@ -562,13 +1116,17 @@ def query_csv(query_text, input_path, input_delim, input_policy, output_path, ou
         if user_init_code == '' and os.path.exists(default_init_source_path):
             user_init_code = read_user_init_code(default_init_source_path)
 
+        if num_workers > 1 and input_path is not None and csv_encoding is not None:
+            if try_query_csv_in_parallel(num_workers, query_text, input_path, input_delim, input_policy, output_stream, output_delim, output_policy, csv_encoding, output_warnings, with_headers, comment_prefix, user_init_code, colorize_output):
+                return
+
         input_file_dir = None if not input_path else os.path.dirname(input_path)
         join_tables_registry = FileSystemCSVRegistry(input_file_dir, input_delim, input_policy, csv_encoding, with_headers, comment_prefix)
-        input_iterator = CSVRecordIterator(input_stream, csv_encoding, input_delim, input_policy, with_headers, comment_prefix=comment_prefix)
+        input_iterator = CSVRecordIterator(input_stream, csv_encoding, input_delim, input_policy, with_headers, comment_prefix=comment_prefix, use_mmap=(input_path is not None and not input_is_compressed))
         output_writer = CSVWriter(output_stream, close_output_on_finish, csv_encoding, output_delim, output_policy, colorize_output=colorize_output)
         if debug_mode:
             rbql_engine.set_debug_mode()
-        rbql_engine.query(query_text, input_iterator, output_writer, output_warnings, join_tables_registry, user_init_code)
+        rbql_engine.query(query_text, input_iterator, output_writer, output_warnings, join_tables_registry, user_init_code, pipelined=pipelined)
     finally:
         if close_input_on_finish:
             input_stream.close()
@@ -5,6 +5,14 @@ from __future__ import print_function
 import sys
 import re
 import ast
+import array
+import copy
+import hashlib
+import struct
+import heapq
+import tempfile
+import threading
+import tokenize
 from collections import OrderedDict, defaultdict, namedtuple
 
 import random # For usage inside user queries only.
@@ -13,6 +21,16 @@ import os # For usage inside user queries only.
 import math # For usage inside user queries only.
 import time # For usage inside user queries only.
 
+try:
+    import queue
+except ImportError: # Python 2
+    import Queue as queue
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
 from ._version import __version__
 
 # This module must be both python2 and python3 compatible.
@@ -47,10 +65,45 @@ numeric_conversion_error = 'Unable to convert value "{}" to int or float. MIN, M
 
 PY3 = sys.version_info[0] == 3
 
+# 64 bit signed integers, typecode "q" is not available in Python 2
+int_array_typecode = 'q' if PY3 else 'l'
+
 RBQL_VERSION = __version__
 
 debug_mode = False
 
+# Number of records requested from the input iterator at once by the main loop
+input_batch_size = 1000
+
+# Max number of record batches in flight between the evaluator and the reader/writer threads in pipelined mode
+pipeline_queue_size = 4
+
+# Approximate amount of memory in bytes for ORDER BY entries. When it is exceeded the entries are sorted and spilled to a temporary file, see SortedWriter
+sort_memory_budget = 512 * 1024 * 1024
+# The size of ORDER BY entries is estimated by measuring every Nth entry only
+sort_size_sample_interval = 100
+# Number of entries serialized together in a spilled sorted run
+sort_spill_chunk_size = 1000
+
+# Groups with at most this number of values are sorted to compute exact MEDIAN and PERCENTILE_EXACT, larger groups use quickselect
+quantile_selection_min_size = 2000
+
+# Size parameter of the sketches used by APPROX_MEDIAN and PERCENTILE. The rank error is inversely proportional to it: about 1.5% for k = 200, the sketch keeps about 3 * k values per group
+quantile_sketch_k = 200
+
+# Estimated size of GROUP BY state after which the groups are spilled to temporary files. Estimates are rough, so the actual memory usage can differ from this value
+group_by_memory_budget = 512 * 1024 * 1024
+# The size of GROUP BY state is estimated once per this number of records
+group_by_size_check_interval = 10000
+# Number of temporary files the spilled groups are hash-partitioned into, each of them is loaded into memory separately at the end of the query
+group_by_spill_partitions = 64
+
+# Calls of these functions with constant arguments are evaluated once per query instead of once per record, see hoist_invariant_expressions(). All functions of the "math" module are included too
+invariant_function_names = set(['int', 'float', 'str', 'bool', 'len', 'abs', 'round', 'tuple', 'frozenset', 'ord', 'chr', 're.compile', 're.escape', 'datetime.date', 'datetime.time', 'datetime.datetime', 'datetime.timedelta', 'datetime.datetime.strptime', 'datetime.datetime.fromisoformat', 'datetime.date.fromisoformat'])
+
+# Number of index bits of the HyperLogLog sketches used by APPROX_COUNT_DISTINCT. A sketch has 2 ** precision one-byte registers and the standard error is about 1.04 / sqrt(2 ** precision): 0.8% for precision = 14
+count_distinct_precision = 14
+
 class RbqlRuntimeError(Exception):
     pass
 
@@ -82,6 +135,8 @@ class RBQLContext:
 
         self.unnest_list = None
         self.top_count = None
+        self.input_batch_size = input_batch_size
+        self.group_by_memory_budget = group_by_memory_budget
 
         self.like_regex_cache = dict()
 
@@ -89,7 +144,10 @@ class RBQLContext:
 
         self.aggregation_stage = 0
         self.aggregation_key_expression = None
+        self.input_is_sorted_by_groups = False
         self.functional_aggregators = []
+        self.aggregate_loop_requested = False
+        self.aggregate_loop_namespace = None
 
         self.join_map_impl = None
         self.join_map = None
@@ -98,10 +156,13 @@ class RBQLContext:
         self.where_expression = None
 
         self.select_expression = None
+        self.select_column_arguments = None
 
         self.update_expressions = None
 
         self.variables_init_code = None
+        self.matched_variables_init_code = None
+        self.hoisted_code = None
 
 
 def is_str6(val):
@@ -309,153 +370,647 @@ class NumHandler:
         except ValueError:
             raise RbqlRuntimeError(numeric_conversion_error.format(val)) # UT JSON
 
+    def merge(self, other):
+        # Values of the other handler come from a later part of the input.
+        # Returns True if these values must be converted to float: in a single pass they would be parsed as floats, because this handler has already switched from int parsing.
+        convert_to_float = self.is_str and not self.is_int
+        if not self.string_detection_done:
+            self.string_detection_done = other.string_detection_done
+            self.is_str = other.is_str
+        self.is_int = self.is_int and other.is_int
+        return convert_to_float
+
+
+def to_float_if_int(val):
+    return float(val) if isinstance(val, int) else val
+
 
 class MinAggregator:
     def __init__(self):
-        self.stats = dict()
         self.num_handler = NumHandler(True)
+        self.convert_to_float = False
+
+    def init_state(self, val):
+        return self.num_handler.parse(val)
 
-    def increment(self, key, val):
+    def increment(self, state, val):
         val = self.num_handler.parse(val)
-        cur_aggr = self.stats.get(key)
-        if cur_aggr is None:
-            self.stats[key] = val
-        else:
-            self.stats[key] = min(cur_aggr, val)
+        return val if val < state else state
+
+    def start_merge(self, other):
+        self.convert_to_float = self.num_handler.merge(other.num_handler)
+
+    def import_state(self, other_state):
+        return to_float_if_int(other_state) if self.convert_to_float else other_state
 
-    def get_final(self, key):
-        return self.stats[key]
+    def merge_states(self, state, other_state):
+        return min(state, self.import_state(other_state))
+
+    def get_final(self, state):
+        return state
 
 
 class MaxAggregator:
     def __init__(self):
-        self.stats = dict()
         self.num_handler = NumHandler(True)
+        self.convert_to_float = False
+
+    def init_state(self, val):
+        return self.num_handler.parse(val)
 
-    def increment(self, key, val):
+    def increment(self, state, val):
         val = self.num_handler.parse(val)
-        cur_aggr = self.stats.get(key)
-        if cur_aggr is None:
-            self.stats[key] = val
-        else:
-            self.stats[key] = max(cur_aggr, val)
+        return val if val > state else state
+
+    def start_merge(self, other):
+        self.convert_to_float = self.num_handler.merge(other.num_handler)
+
+    def import_state(self, other_state):
+        return to_float_if_int(other_state) if self.convert_to_float else other_state
+
+    def merge_states(self, state, other_state):
+        return max(state, self.import_state(other_state))
 
-    def get_final(self, key):
-        return self.stats[key]
+    def get_final(self, state):
+        return state
 
 
 class SumAggregator:
     def __init__(self):
-        self.stats = defaultdict(int)
         self.num_handler = NumHandler(True)
+        self.convert_to_float = False
 
-    def increment(self, key, val):
-        val = self.num_handler.parse(val)
-        self.stats[key] += val
+    def init_state(self, val):
+        return self.num_handler.parse(val)
+
+    def increment(self, state, val):
+        return state + self.num_handler.parse(val)
+
+    def start_merge(self, other):
+        self.convert_to_float = self.num_handler.merge(other.num_handler)
+
+    def import_state(self, other_state):
+        return to_float_if_int(other_state) if self.convert_to_float else other_state
 
-    def get_final(self, key):
-        return self.stats[key]
+    def merge_states(self, state, other_state):
+        return state + self.import_state(other_state)
+
+    def get_final(self, state):
+        return state
 
 
 class AvgAggregator:
+    # The state is a mutable [sum, count] list
     def __init__(self):
-        self.stats = dict()
         self.num_handler = NumHandler(False)
 
-    def increment(self, key, val):
-        val = self.num_handler.parse(val)
-        cur_aggr = self.stats.get(key)
-        if cur_aggr is None:
-            self.stats[key] = (val, 1)
-        else:
-            cur_sum, cur_cnt = cur_aggr
-            self.stats[key] = (cur_sum + val, cur_cnt + 1)
+    def init_state(self, val):
+        return [self.num_handler.parse(val), 1]
 
-    def get_final(self, key):
-        final_sum, final_cnt = self.stats[key]
-        return float(final_sum) / final_cnt
+    def increment(self, state, val):
+        state[0] += self.num_handler.parse(val)
+        state[1] += 1
+        return state
+
+    def start_merge(self, other):
+        self.num_handler.merge(other.num_handler)
+
+    def import_state(self, other_state):
+        return other_state
+
+    def merge_states(self, state, other_state):
+        state[0] += other_state[0]
+        state[1] += other_state[1]
+        return state
+
+    def get_final(self, state):
+        return float(state[0]) / state[1]
 
 
 class VarianceAggregator:
-    def __init__(self):
-        self.stats = dict()
+    # Implements VARIANCE, STDDEV, VAR_SAMP and STDDEV_SAMP with Welford's algorithm: the [count, mean, sum of squared deviations from the mean] state is updated in place for every value.
+    # Unlike the naive sum of squares approach this doesn't lose precision when the mean is large compared to the deviations.
+    def __init__(self, is_sample=False, take_sqrt=False):
         self.num_handler = NumHandler(False)
+        self.is_sample = is_sample
+        self.take_sqrt = take_sqrt
+
+    def init_state(self, val):
+        return [1, float(self.num_handler.parse(val)), 0.0]
 
-    def increment(self, key, val):
+    def increment(self, state, val):
         val = self.num_handler.parse(val)
-        cur_aggr = self.stats.get(key)
-        if cur_aggr is None:
-            self.stats[key] = (val, val ** 2, 1)
+        state[0] += 1
+        delta = val - state[1]
+        state[1] += delta / state[0]
+        state[2] += delta * (val - state[1])
+        return state
+
+    def start_merge(self, other):
+        self.num_handler.merge(other.num_handler)
+
+    def import_state(self, other_state):
+        return other_state
+
+    def merge_states(self, state, other_state):
+        # Uses the pairwise update formula by Chan et al.
+        cur_cnt, other_cnt = state[0], other_state[0]
+        total_cnt = cur_cnt + other_cnt
+        delta = other_state[1] - state[1]
+        state[0] = total_cnt
+        state[1] += delta * other_cnt / total_cnt
+        state[2] += other_state[2] + delta ** 2 * cur_cnt * other_cnt / total_cnt
+        return state
+
+    def get_final(self, state):
+        final_cnt, _final_mean, final_sum_of_squares = state
+        if self.is_sample:
+            if final_cnt < 2:
+                return None
+            result = final_sum_of_squares / (final_cnt - 1)
         else:
-            cur_sum, cur_sum_of_squares, cur_cnt = cur_aggr
-            self.stats[key] = (cur_sum + val, cur_sum_of_squares + val ** 2, cur_cnt + 1)
+            result = final_sum_of_squares / final_cnt
+        return math.sqrt(result) if self.take_sqrt else result
 
-    def get_final(self, key):
-        final_sum, final_sum_of_squares, final_cnt = self.stats[key]
-        return float(final_sum_of_squares) / final_cnt - (float(final_sum) / final_cnt) ** 2
 
+def select_kth_smallest(values, k):
+    # Quickselect with a median of three pivot, expected O(n). Values equal to the pivot are handled as a single block, so duplicates don't slow it down.
+    # Small lists are sorted instead, because the builtin sort is faster than the partitioning loop below for them.
+    while True:
+        if len(values) <= quantile_selection_min_size:
+            return sorted(values)[k]
+        pivot = sorted([values[0], values[len(values) // 2], values[-1]])[1]
+        lower_values = [v for v in values if v < pivot]
+        if k < len(lower_values):
+            values = lower_values
+            continue
+        higher_values = [v for v in values if pivot < v]
+        num_not_higher = len(values) - len(higher_values)
+        if k < num_not_higher:
+            return pivot
+        k -= num_not_higher
+        values = higher_values
 
-class MedianAggregator:
-    def __init__(self):
-        self.stats = defaultdict(list)
-        self.num_handler = NumHandler(True)
 
-    def increment(self, key, val):
+def get_nearest_rank_index(quantile, num_values):
+    # Rounding prevents float errors like 0.7 * 10 = 7.000000000000001 from shifting the rank
+    return max(0, int(math.ceil(round(quantile * num_values, 9))) - 1)
+
+
+# The state of exact quantile aggregators is a list of 3 buffers. Ints and floats are stored unboxed in typed arrays, which takes 3-4 times less memory than a list.
+# Values of other types and ints which don't fit into 64 bits are stored in a regular list.
+quantile_buffer_factories = [lambda: array.array(int_array_typecode), lambda: array.array('d'), list]
+quantile_buffer_indices_by_type = {int: 0, float: 1}
+
+
+def copy_quantile_buffers(state):
+    return [None if buffer is None else buffer[:] for buffer in state]
+
+
+def get_quantile_values(state):
+    result = []
+    for buffer in state:
+        if buffer is not None:
+            result.extend(buffer)
+    return result
+
+
+class ExactQuantileAggregator:
+    # Implements MEDIAN and PERCENTILE_EXACT.
+    # Aggregators with the same argument expression in the SELECT clause e.g. MEDIAN(a1) and PERCENTILE_EXACT(a1, 0.9) become sharers of the first such aggregator (the source).
+    # A sharer uses the state of the source as long as they get the same values in the group, on the first different value it gets a copy of the state without the last value of the source.
+    # So the results are correct even if the same expression gives different values e.g. with a user-defined function that has side effects.
+    def __init__(self, quantile=None):
+        self.quantile = quantile # None means MEDIAN which averages the two middle values of groups with an even number of values
+        self.num_handler = NumHandler(True)
+        self.convert_to_float = False
+        self.index = None
+        self.source = None
+        self.has_sharers = False
+        # The state which was updated last by a source aggregator, the last value and the index of the buffer it was added to
+        self.last_state = None
+        self.last_value = None
+        self.last_buffer_index = None
+
+    def share_state_if_possible(self, preceding_aggregators, preceding_arguments, argument):
+        # Must be called on the first record before init_state()
+        # The arguments are the source texts of the first arguments of the aggregate functions, None if the text is unknown e.g. for non-aggregate columns
+        self.index = len(preceding_aggregators)
+        if argument is None:
+            return
+        for aggregator, preceding_argument in zip(preceding_aggregators, preceding_arguments):
+            if isinstance(aggregator, ExactQuantileAggregator) and aggregator.source is None and preceding_argument == argument:
+                self.source = aggregator
+                aggregator.has_sharers = True
+                return
+
+    def add(self, state, val):
+        # val must be already parsed
+        buffer_index = quantile_buffer_indices_by_type.get(type(val), 2)
+        buffer = state[buffer_index]
+        if buffer is None:
+            buffer = quantile_buffer_factories[buffer_index]()
+            state[buffer_index] = buffer
+        try:
+            buffer.append(val)
+        except OverflowError:
+            buffer_index = 2
+            if state[buffer_index] is None:
+                state[buffer_index] = list()
+            state[buffer_index].append(val)
+        if self.has_sharers:
+            self.last_state = state
+            self.last_value = val
+            self.last_buffer_index = buffer_index
+        return state
+
+    def increment_shared(self, state, val):
+        # state is None for a new group
+        source = self.source
         val = self.num_handler.parse(val)
-        self.stats[key].append(val)
-
-    def get_final(self, key):
-        sorted_vals = sorted(self.stats[key])
-        assert len(sorted_vals)
-        m = int(len(sorted_vals) / 2)
-        if len(sorted_vals) % 2:
-            return sorted_vals[m]
-        else:
-            a = sorted_vals[m - 1]
-            b = sorted_vals[m]
-            return a if a == b else (a + b) / 2.0
+        if state is None or state is source.last_state:
+            last_value = source.last_value
+            if val is last_value or (val == last_value and type(val) is type(last_value)):
+                return source.last_state
+            if state is None:
+                state = [None, None, None]
+            else:
+                state = copy_quantile_buffers(state)
+                state[source.last_buffer_index].pop()
+        return self.add(state, val)
+
+    def init_state(self, val):
+        if self.source is not None:
+            return self.increment_shared(None, val)
+        return self.add([None, None, None], self.num_handler.parse(val))
+
+    def increment(self, state, val):
+        if self.source is not None:
+            return self.increment_shared(state, val)
+        return self.add(state, self.num_handler.parse(val))
+
+    def start_merge(self, other):
+        self.convert_to_float = self.num_handler.merge(other.num_handler)
+
+    def import_state(self, other_state):
+        if not self.convert_to_float:
+            return other_state
+        # The buffers are always copied, because the other state can be shared by several aggregators
+        int_buffer, float_buffer, other_buffer = other_state
+        float_buffer = array.array('d') if float_buffer is None else float_buffer[:]
+        if int_buffer is not None:
+            float_buffer.extend(array.array('d', int_buffer))
+        if other_buffer is not None:
+            other_buffer = [to_float_if_int(v) for v in other_buffer]
+        return [None, float_buffer if len(float_buffer) else None, other_buffer]
+
+    def merge_states(self, state, other_state):
+        for buffer_index, other_buffer in enumerate(self.import_state(other_state)):
+            if other_buffer is None:
+                continue
+            if state[buffer_index] is None:
+                state[buffer_index] = quantile_buffer_factories[buffer_index]()
+            state[buffer_index].extend(other_buffer)
+        return state
+
+    def get_final(self, state):
+        values = get_quantile_values(state)
+        assert len(values)
+        if self.quantile is not None:
+            return select_kth_smallest(values, get_nearest_rank_index(self.quantile, len(values)))
+        m = int(len(values) / 2)
+        if len(values) % 2:
+            return select_kth_smallest(values, m)
+        a = select_kth_smallest(values, m - 1)
+        b = select_kth_smallest(values, m)
+        return a if a == b else (a + b) / 2.0
+
+
+class QuantileSketch(object):
+    # KLL quantile sketch: a hierarchy of compactors, a value at level h represents 2 ** h input values.
+    # When the sketch is full a compactor is sorted and every other value is promoted to the next level.
+    # The choice between odd and even values alternates instead of being random to keep query results reproducible.
+    def __init__(self, k):
+        self.k = k
+        self.compactors = []
+        self.size = 0
+        self.max_size = 0
+        self.offset = 0
+        self.grow()
+
+    def grow(self):
+        self.compactors.append([])
+        self.max_size = sum([self.capacity(level) for level in range(len(self.compactors))])
+
+    def capacity(self, level):
+        depth = len(self.compactors) - level - 1
+        return int(math.ceil(self.k * (2.0 / 3) ** depth)) + 1
+
+    def update(self, val):
+        self.compactors[0].append(val)
+        self.size += 1
+        if self.size >= self.max_size:
+            self.compress()
+
+    def compress(self):
+        for level in range(len(self.compactors)):
+            compactor = self.compactors[level]
+            if len(compactor) < self.capacity(level):
+                continue
+            if level + 1 == len(self.compactors):
+                self.grow()
+            compactor.sort()
+            # With an odd number of values the smallest one stays at the current level, so the total weight is preserved exactly
+            num_kept = len(compactor) % 2
+            self.compactors[level + 1].extend(compactor[num_kept + self.offset::2])
+            self.offset ^= 1
+            self.compactors[level] = compactor[:num_kept]
+            self.size = sum([len(c) for c in self.compactors])
+            if self.size < self.max_size:
+                break
+
+    def merge(self, other):
+        while len(self.compactors) < len(other.compactors):
+            self.grow()
+        for level, compactor in enumerate(other.compactors):
+            self.compactors[level].extend(compactor)
+        self.size += other.size
+        while self.size >= self.max_size:
+            self.compress()
+
+    def convert_values(self, converter):
+        self.compactors = [[converter(v) for v in compactor] for compactor in self.compactors]
+
+    def get_quantile(self, quantile):
+        # Returns the smallest stored value which is greater or equal to the given fraction of the input values (the "nearest rank" method)
+        weighted_values = []
+        total_weight = 0
+        for level, compactor in enumerate(self.compactors):
+            weight = 1 << level
+            total_weight += weight * len(compactor)
+            weighted_values += [(v, weight) for v in compactor]
+        weighted_values.sort(key=lambda x: x[0])
+        target_weight = round(quantile * total_weight, 9) # See get_nearest_rank_index()
+        cumulative_weight = 0
+        for v, weight in weighted_values:
+            cumulative_weight += weight
+            if cumulative_weight >= target_weight:
+                return v
+        return weighted_values[-1][0]
+
+
+def parse_quantile(function_name, quantile):
+    try:
+        quantile = float(quantile)
+    except (TypeError, ValueError):
+        quantile = None
+    if quantile is None or quantile < 0 or quantile > 1:
+        raise RbqlRuntimeError('{} quantile must be a number between 0 and 1'.format(function_name))
+    return quantile
+
+
+class ApproxQuantileAggregator:
+    def __init__(self, quantile):
+        self.num_handler = NumHandler(True)
+        self.convert_to_float = False
+        self.quantile = quantile
+
+    def init_state(self, val):
+        sketch = QuantileSketch(quantile_sketch_k)
+        sketch.update(self.num_handler.parse(val))
+        return sketch
+
+    def increment(self, state, val):
+        state.update(self.num_handler.parse(val))
+        return state
+
+    def start_merge(self, other):
+        self.convert_to_float = self.num_handler.merge(other.num_handler)
+
+    def import_state(self, other_state):
+        if self.convert_to_float:
+            other_state.convert_values(to_float_if_int)
+        return other_state
+
+    def merge_states(self, state, other_state):
+        state.merge(self.import_state(other_state))
+        return state
+
+    def get_final(self, state):
+        return state.get_quantile(self.quantile)
 
 
 class CountAggregator:
-    def __init__(self):
-        self.stats = defaultdict(int)
+    def init_state(self, _val):
+        return 1
+
+    def increment(self, state, _val):
+        return state + 1
+
+    def start_merge(self, other):
+        pass
 
-    def increment(self, key, _val):
-        self.stats[key] += 1
+    def import_state(self, other_state):
+        return other_state
+
+    def merge_states(self, state, other_state):
+        return state + other_state
+
+    def get_final(self, state):
+        return state
+
+
+def hash64(val):
+    # Builtin hash() is randomized per process, so it can't be used for sketches which are built in parallel worker processes and then merged
+    if not is_str6(val):
+        val = repr(val)
+    return struct.unpack('<Q', hashlib.sha1(val.encode('utf-8')).digest()[:8])[0]
+
+
+class HyperLogLog(object):
+    # Small sets of hashes are stored as is: this gives exact counts and uses less memory for groups with few distinct values.
+    # Registers are allocated once the set becomes larger than them.
+    def __init__(self, precision):
+        self.precision = precision
+        self.num_registers = 1 << precision
+        self.max_sparse_size = self.num_registers // 64
+        self.sparse_hashes = set()
+        self.registers = None
+
+    def add(self, hash_value):
+        if self.registers is not None:
+            self.update_register(hash_value)
+            return
+        self.sparse_hashes.add(hash_value)
+        if len(self.sparse_hashes) > self.max_sparse_size:
+            self.convert_to_dense()
+
+    def update_register(self, hash_value):
+        # The first bits of the hash select a register, the register keeps the max position of the first set bit in the remaining bits
+        num_suffix_bits = 64 - self.precision
+        index = hash_value >> num_suffix_bits
+        rank = num_suffix_bits - (hash_value & ((1 << num_suffix_bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def convert_to_dense(self):
+        self.registers = bytearray(self.num_registers)
+        for hash_value in self.sparse_hashes:
+            self.update_register(hash_value)
+        self.sparse_hashes = None
+
+    def merge(self, other):
+        if other.registers is None:
+            for hash_value in other.sparse_hashes:
+                self.add(hash_value)
+            return
+        if self.registers is None:
+            self.convert_to_dense()
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def get_cardinality(self):
+        # Uses the improved estimator from "New cardinality estimation algorithms for HyperLogLog sketches" by Otmar Ertl which, unlike the original one, has no bias at medium cardinalities
+        if self.registers is None:
+            return len(self.sparse_hashes)
+        m = self.num_registers
+        num_suffix_bits = 64 - self.precision
+        rank_counts = [0] * (num_suffix_bits + 2)
+        for rank in self.registers:
+            rank_counts[rank] += 1
+        z = m * hll_tau(1 - float(rank_counts[num_suffix_bits + 1]) / m)
+        for rank in range(num_suffix_bits, 0, -1):
+            z = 0.5 * (z + rank_counts[rank])
+        z += m * hll_sigma(float(rank_counts[0]) / m)
+        return int(round(m * m / (2 * math.log(2) * z)))
+
+
+def hll_sigma(x):
+    if x == 1:
+        return float('inf')
+    y = 1
+    z = x
+    while True:
+        x *= x
+        prev_z = z
+        z += x * y
+        y += y
+        if z == prev_z:
+            return z
+
+
+def hll_tau(x):
+    if x == 0 or x == 1:
+        return 0
+    y = 1.0
+    z = 1 - x
+    while True:
+        x = math.sqrt(x)
+        prev_z = z
+        y *= 0.5
+        z -= (1 - x) ** 2 * y
+        if z == prev_z:
+            return z / 3
 
-    def get_final(self, key):
-        return self.stats[key]
+
+class ApproxCountDistinctAggregator:
+    def init_state(self, val):
+        sketch = HyperLogLog(count_distinct_precision)
+        sketch.add(hash64(val))
+        return sketch
+
+    def increment(self, state, val):
+        state.add(hash64(val))
+        return state
+
+    def start_merge(self, other):
+        pass
+
+    def import_state(self, other_state):
+        return other_state
+
+    def merge_states(self, state, other_state):
+        state.merge(other_state)
+        return state
+
+    def get_final(self, state):
+        return state.get_cardinality()
+
+
+class CountDistinctAggregator:
+    def init_state(self, val):
+        return set([val])
+
+    def increment(self, state, val):
+        state.add(val)
+        return state
+
+    def start_merge(self, other):
+        pass
+
+    def import_state(self, other_state):
+        return other_state
+
+    def merge_states(self, state, other_state):
+        state.update(other_state)
+        return state
+
+    def get_final(self, state):
+        return len(state)
 
 
 class ArrayAggAggregator:
     def __init__(self, post_proc=None):
-        self.stats = defaultdict(list)
         self.post_proc = post_proc
 
-    def increment(self, key, val):
-        self.stats[key].append(val)
+    def init_state(self, val):
+        return [val]
+
+    def increment(self, state, val):
+        state.append(val)
+        return state
+
+    def start_merge(self, other):
+        pass
+
+    def import_state(self, other_state):
+        return other_state
+
+    def merge_states(self, state, other_state):
+        # The other state must come from a later part of the input to preserve the order of values
+        state.extend(other_state)
+        return state
 
-    def get_final(self, key):
-        res = self.stats[key]
+    def get_final(self, state):
         if self.post_proc is not None:
-            return self.post_proc(res)
-        return res
+            return self.post_proc(state)
+        return state
 
 
 class ConstGroupVerifier:
     def __init__(self, output_index):
-        self.const_values = dict()
         self.output_index = output_index
 
-    def increment(self, key, value):
-        old_value = self.const_values.get(key)
-        if old_value is None:
-            self.const_values[key] = value
-        elif old_value != value:
-            raise RbqlRuntimeError('Invalid aggregate expression: non-constant values in output column {}. E.g. "{}" and "{}"'.format(self.output_index + 1, old_value, value)) # UT JSON
+    def init_state(self, value):
+        return value
+
+    def increment(self, state, value):
+        if state is None:
+            return value
+        if state != value:
+            raise RbqlRuntimeError('Invalid aggregate expression: non-constant values in output column {}. E.g. "{}" and "{}"'.format(self.output_index + 1, state, value)) # UT JSON
+        return state
+
+    def start_merge(self, other):
+        pass
 
-    def get_final(self, key):
-        return self.const_values[key]
+    def import_state(self, other_state):
+        return other_state
+
+    def merge_states(self, state, other_state):
+        return self.increment(state, other_state)
+
+    def get_final(self, state):
+        return state
 
 
 def add_to_set(dst_set, value):
@@ -512,6 +1067,11 @@ class UniqCountWriter(object):
             self.records[record] = 1
         return True
 
+    def merge(self, other):
+        # The other writer must come from a later part of the input to preserve the order of records
+        for record, cnt in iteritems6(other.records):
+            self.records[record] = self.records.get(record, 0) + cnt
+
     def finish(self):
         for record, cnt in iteritems6(self.records):
             mutable_record = list(record)
@@ -521,38 +1081,362 @@ class UniqCountWriter(object):
         self.subwriter.finish()
 
 
+def estimate_sort_entry_size(sort_key_value, record):
+    # Rough estimate, values shared between the sort key and the record are counted twice
+    result = sys.getsizeof(record) + sys.getsizeof(sort_key_value) + 64
+    for v in record:
+        result += sys.getsizeof(v)
+    if isinstance(sort_key_value, tuple):
+        for v in sort_key_value:
+            result += sys.getsizeof(v)
+    return result
+
+
+class ReverseOrderKey(object):
+    __slots__ = ['value']
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+class SortedRunFile(object):
+    # Sorted entries of SortedWriter stored in a temporary file
+    def __init__(self, sorted_entries):
+        self.stream = tempfile.TemporaryFile(prefix='rbql_sort_')
+        for i in range(0, len(sorted_entries), sort_spill_chunk_size):
+            pickle.dump(sorted_entries[i:i + sort_spill_chunk_size], self.stream, pickle.HIGHEST_PROTOCOL)
+
+    def iterate_entries(self):
+        self.stream.seek(0)
+        while True:
+            try:
+                chunk = pickle.load(self.stream)
+            except EOFError:
+                return
+            for entry in chunk:
+                yield entry
+
+    def close(self):
+        self.stream.close()
+
+
+def merge_sorted_runs(runs, reverse_sort):
+    # K-way merge of iterables of (sort_key, record) entries. Equal keys are ordered by the run index, so if runs are consecutive parts of the input sorted with a stable sort, the merge is stable too.
+    # For reverse_sort the runs must be sorted in the reverse order, the result is the same as a stable ascending sort followed by reverse().
+    heap = []
+    for run_index, run in enumerate(runs):
+        run_iterator = iter(run)
+        for sort_key_value, record in run_iterator:
+            merge_key = (sort_key_value, run_index)
+            heap.append([ReverseOrderKey(merge_key) if reverse_sort else merge_key, record, run_index, run_iterator])
+            break
+    heapq.heapify(heap)
+    while heap:
+        top = heap[0]
+        yield top[1]
+        for sort_key_value, record in top[3]:
+            merge_key = (sort_key_value, top[2])
+            top[0] = ReverseOrderKey(merge_key) if reverse_sort else merge_key
+            top[1] = record
+            heapq.heapreplace(heap, top)
+            break
+        else:
+            heapq.heappop(heap)
+
+
 class SortedWriter(object):
+    # Entries are accumulated in memory until their estimated size exceeds sort_memory_budget, then they are sorted and spilled to a temporary file as a sorted run.
+    # finish() merges all spilled runs with the entries remaining in memory.
     def __init__(self, subwriter, reverse_sort):
         self.subwriter = subwriter
         self.reverse_sort = reverse_sort
         self.unsorted_entries = list()
+        self.unsorted_entries_size = 0
+        self.sorted_runs = list()
 
     def write(self, sort_key_value, record):
         self.unsorted_entries.append((sort_key_value, record))
+        if len(self.unsorted_entries) % sort_size_sample_interval == 0:
+            self.unsorted_entries_size += estimate_sort_entry_size(sort_key_value, record) * sort_size_sample_interval
+            if self.unsorted_entries_size > sort_memory_budget:
+                self.sorted_runs.append(SortedRunFile(self.sort_unsorted_entries()))
         return True
 
-    def finish(self):
+    def sort_unsorted_entries(self):
         sorted_entries = sorted(self.unsorted_entries, key=lambda x: x[0])
         if self.reverse_sort:
             sorted_entries.reverse()
+        self.unsorted_entries = list()
+        self.unsorted_entries_size = 0
+        return sorted_entries
+
+    def finish(self):
+        try:
+            if len(self.sorted_runs):
+                sorted_records = merge_sorted_runs([run.iterate_entries() for run in self.sorted_runs] + [self.sort_unsorted_entries()], self.reverse_sort)
+            else:
+                sorted_records = (e[1] for e in self.sort_unsorted_entries())
+            for record in sorted_records:
+                if not self.subwriter.write(record):
+                    break
+        finally:
+            for run in self.sorted_runs:
+                run.close()
+        self.subwriter.finish()
+
+
+class TopSortedWriter(object):
+    # Replaces SortedWriter for ORDER BY queries with LIMIT/TOP: only the top_count best entries are kept in a bounded heap.
+    # Produces the same output as SortedWriter: equal keys are ordered by insertion order and reversed together with the keys for DESC.
+    def __init__(self, subwriter, reverse_sort, top_count):
+        self.subwriter = subwriter
+        self.reverse_sort = reverse_sort
+        self.top_count = top_count
+        self.num_entries = 0
+        # For ascending sort the heap top is the largest kept entry and for descending sort it is the smallest one, i.e. the first one to be replaced.
+        self.heap = []
+
+    def write(self, sort_key_value, record):
+        self.num_entries += 1
+        if len(self.heap) < self.top_count:
+            heap_key = (sort_key_value, self.num_entries)
+            heapq.heappush(self.heap, [heap_key if self.reverse_sort else ReverseOrderKey(heap_key), sort_key_value, self.num_entries, record])
+            return True
+        if not len(self.heap):
+            return True
+        # A new entry always loses a tie with the kept entries in ascending order and always wins it in descending order
+        top_key_value = self.heap[0][1]
+        if self.reverse_sort:
+            if sort_key_value < top_key_value:
+                return True
+        elif not sort_key_value < top_key_value:
+            return True
+        heap_key = (sort_key_value, self.num_entries)
+        heapq.heapreplace(self.heap, [heap_key if self.reverse_sort else ReverseOrderKey(heap_key), sort_key_value, self.num_entries, record])
+        return True
+
+    def finish(self):
+        sorted_entries = sorted(self.heap, key=lambda e: (e[1], e[2]), reverse=self.reverse_sort)
         for e in sorted_entries:
-            if not self.subwriter.write(e[1]):
+            if not self.subwriter.write(e[3]):
                 break
         self.subwriter.finish()
 
 
+def estimate_object_size(obj):
+    # Rough estimate of the memory used by an object together with the objects it references. Only the first elements of containers are measured, the rest are assumed to be similar.
+    result = sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple, set)):
+        elements = obj
+    elif hasattr(obj, '__dict__'):
+        elements = obj.__dict__.values()
+    else:
+        return result
+    num_measured = 0
+    measured_size = 0
+    for element in elements:
+        if num_measured == 10:
+            break
+        measured_size += estimate_object_size(element)
+        num_measured += 1
+    if num_measured:
+        result += measured_size * len(elements) // num_measured
+    return result
+
+
+def copy_aggregators_for_pickling(aggregators):
+    # The copies don't reference the state of the last updated group and the ARRAY_AGG post-processing function which can be a lambda. They can't be used to compute the final values.
+    result = []
+    for aggregator in aggregators:
+        aggregator_copy = copy.copy(aggregator)
+        if isinstance(aggregator, ExactQuantileAggregator):
+            aggregator_copy.last_state = None
+            aggregator_copy.last_value = None
+            if aggregator.source is not None:
+                aggregator_copy.source = result[aggregator.source.index]
+        elif isinstance(aggregator, ArrayAggAggregator):
+            aggregator_copy.post_proc = None
+        result.append(aggregator_copy)
+    return result
+
+
+def is_shared_quantile_state(aggregator, states):
+    return isinstance(aggregator, ExactQuantileAggregator) and aggregator.source is not None and states[aggregator.index] is states[aggregator.source.index]
+
+
+def merge_groups(aggregators, groups, other_aggregators, other_groups):
+    # The other groups must come from a later part of the input, because some aggregators e.g. ARRAY_AGG depend on the order of values
+    if len(aggregators) != len(other_aggregators):
+        raise RbqlRuntimeError(wrong_aggregation_usage_error)
+    for aggregator, other_aggregator in zip(aggregators, other_aggregators):
+        if aggregator.__class__ is not other_aggregator.__class__: # type() is the same "instance" type for all old-style classes in Python 2
+            raise RbqlRuntimeError(wrong_aggregation_usage_error)
+        aggregator.start_merge(other_aggregator)
+    # A state shared by exact quantile aggregators is merged by the source only if it is shared in the other group too and both aggregators convert the other values in the same way.
+    # Otherwise the sharer gets its own copy of the state. Existing states are merged in the reverse order, so that the copy is made before the source extends the shared state.
+    for key, other_states in iteritems6(other_groups):
+        states = groups.get(key)
+        if states is None:
+            states = []
+            for aggregator, other_state in zip(aggregators, other_states):
+                if is_shared_quantile_state(aggregator, other_states) and aggregator.convert_to_float == aggregator.source.convert_to_float:
+                    states.append(states[aggregator.source.index])
+                    continue
+                state = aggregator.import_state(other_state)
+                if isinstance(aggregator, ExactQuantileAggregator) and any(state is s for s in states):
+                    state = copy_quantile_buffers(state) # The state was shared in the other group, but it can't be shared here
+                states.append(state)
+            groups[key] = states
+            continue
+        for i in range(len(aggregators) - 1, -1, -1):
+            aggregator = aggregators[i]
+            if is_shared_quantile_state(aggregator, states):
+                if is_shared_quantile_state(aggregator, other_states) and aggregator.convert_to_float == aggregator.source.convert_to_float:
+                    continue
+                states[i] = copy_quantile_buffers(states[i])
+            states[i] = aggregator.merge_states(states[i], other_states[i])
+
+
 class AggregateWriter(object):
+    # The states of all aggregators of a group are stored in a single list, so a record needs only one hash table lookup.
+    # When the estimated size of the groups exceeds memory_budget, their states are hash-partitioned into temporary files and the aggregation starts over with empty states.
+    # finish() then loads and merges the spilled states one partition at a time, and merges the sorted outputs of the partitions to keep the output sorted by the group key.
+    # Like in merge_partial_results() float sums are accumulated in a different order after spilling, so they can differ from the in-memory result in the last digits.
+    def __init__(self, subwriter, memory_budget=None):
+        self.subwriter = subwriter
+        self.aggregators = []
+        self.groups = dict()
+        self.memory_budget = memory_budget
+        self.num_records_since_size_check = 0
+        self.spilled_partitions = None
+
+    def merge(self, other):
+        assert self.spilled_partitions is None and other.spilled_partitions is None
+        merge_groups(self.aggregators, self.groups, other.aggregators, other.groups)
+
+    def aggregate(self, key, values):
+        states = self.groups.get(key)
+        if states is None:
+            self.groups[key] = [aggregator.init_state(val) for aggregator, val in zip(self.aggregators, values)]
+        else:
+            aggregators = self.aggregators
+            for i, val in enumerate(values):
+                states[i] = aggregators[i].increment(states[i], val)
+        self.num_records_since_size_check += 1
+        if self.num_records_since_size_check >= group_by_size_check_interval:
+            self.check_memory_usage()
+        return True
+
+    def check_memory_usage(self):
+        self.num_records_since_size_check = 0
+        if self.memory_budget is None or not len(self.groups):
+            return
+        num_sampled_groups = 0
+        sampled_size = 0
+        for key, states in iteritems6(self.groups):
+            sampled_size += estimate_object_size(key) + estimate_object_size(states) + 100 # Approximate overhead of a dict entry
+            num_sampled_groups += 1
+            if num_sampled_groups == 16:
+                break
+        if sampled_size * len(self.groups) // num_sampled_groups > self.memory_budget:
+            self.spill()
+
+    def spill(self):
+        if self.spilled_partitions is None:
+            self.spilled_partitions = [tempfile.TemporaryFile(prefix='rbql_group_by_') for _ in range(group_by_spill_partitions)]
+        partitioned_groups = [dict() for _ in range(group_by_spill_partitions)]
+        for key, states in iteritems6(self.groups):
+            partitioned_groups[hash(key) % group_by_spill_partitions][key] = states
+        self.groups = dict()
+        aggregators_copy = copy_aggregators_for_pickling(self.aggregators)
+        for groups, stream in zip(partitioned_groups, self.spilled_partitions):
+            if len(groups):
+                pickle.dump((aggregators_copy, groups), stream, pickle.HIGHEST_PROTOCOL)
+
+    def load_spilled_partition(self, stream):
+        merged_aggregators = None
+        merged_groups = None
+        stream.seek(0)
+        while True:
+            try:
+                spilled_aggregators, spilled_groups = pickle.load(stream)
+            except EOFError:
+                break
+            if merged_groups is None:
+                merged_aggregators, merged_groups = spilled_aggregators, spilled_groups
+            else:
+                merge_groups(merged_aggregators, merged_groups, spilled_aggregators, spilled_groups)
+        stream.close()
+        return merged_groups
+
+    def write_groups(self, groups):
+        # Returns False if the subwriter doesn't accept more records
+        for key in sorted(groups):
+            if not self.subwriter.write([aggregator.get_final(state) for aggregator, state in zip(self.aggregators, groups[key])]):
+                return False
+        return True
+
+    def finish(self):
+        if self.spilled_partitions is None:
+            self.write_groups(self.groups)
+            self.subwriter.finish()
+            return
+        self.spill()
+        sorted_runs = []
+        try:
+            for stream in self.spilled_partitions:
+                groups = self.load_spilled_partition(stream)
+                if groups is not None:
+                    sorted_runs.append(SortedRunFile([(key, [aggregator.get_final(state) for aggregator, state in zip(self.aggregators, groups[key])]) for key in sorted(groups)]))
+            for out_fields in merge_sorted_runs([run.iterate_entries() for run in sorted_runs], False):
+                if not self.subwriter.write(out_fields):
+                    break
+        finally:
+            for run in sorted_runs:
+                run.close()
+        self.subwriter.finish()
+
+
+def format_group_key(key):
+    return ', '.join([str(v) for v in key]) if isinstance(key, tuple) else str(key)
+
+
+class StreamingAggregateWriter(object):
+    # Used with `WITH (sorted)` query modifier when the input records are sorted by the GROUP BY key.
+    # Each group is written as soon as the key changes, so only the current group is kept in memory and the output order is the same as with AggregateWriter.
     def __init__(self, subwriter):
         self.subwriter = subwriter
         self.aggregators = []
-        self.aggregation_keys = set()
+        self.current_key = None
+        self.current_states = None
+
+    def aggregate(self, key, values):
+        states = self.current_states
+        if states is not None and (key is self.current_key or key == self.current_key):
+            aggregators = self.aggregators
+            for i, val in enumerate(values):
+                states[i] = aggregators[i].increment(states[i], val)
+            return True
+        if states is not None:
+            if key < self.current_key:
+                raise RbqlRuntimeError('Input is not sorted by the GROUP BY key as required by "WITH (sorted)": group "{}" comes after group "{}"'.format(format_group_key(key), format_group_key(self.current_key)))
+            if not self.write_current_group():
+                return False
+        self.current_key = key
+        self.current_states = [aggregator.init_state(val) for aggregator, val in zip(self.aggregators, values)]
+        return True
+
+    def write_current_group(self):
+        out_fields = [aggregator.get_final(state) for aggregator, state in zip(self.aggregators, self.current_states)]
+        self.current_states = None
+        return self.subwriter.write(out_fields)
 
     def finish(self):
-        all_keys = sorted(list(self.aggregation_keys))
-        for key in all_keys:
-            out_fields = [ag.get_final(key) for ag in self.aggregators]
-            if not self.subwriter.write(out_fields):
-                break
+        if self.current_states is not None:
+            self.write_current_group()
         self.subwriter.finish()
 
 
@@ -607,48 +1491,70 @@ def select_simple(query_context, sort_key, out_fields):
 
 def select_aggregated(query_context, key, transparent_values):
     if query_context.aggregation_stage == 1:
-        if type(query_context.writer) is SortedWriter or type(query_context.writer) is UniqWriter or type(query_context.writer) is UniqCountWriter:
+        if type(query_context.writer) is SortedWriter or type(query_context.writer) is TopSortedWriter or type(query_context.writer) is UniqWriter or type(query_context.writer) is UniqCountWriter:
             raise RbqlParsingError(invalid_keyword_in_aggregate_query_error_msg) # UT JSON
-        query_context.writer = AggregateWriter(query_context.writer)
+        if query_context.input_is_sorted_by_groups:
+            writer = StreamingAggregateWriter(query_context.writer)
+        else:
+            writer = AggregateWriter(query_context.writer, query_context.group_by_memory_budget)
         num_aggregators_found = 0
-        for i, trans_value in enumerate(transparent_values):
+        values = []
+        column_arguments = query_context.select_column_arguments
+        if column_arguments is None or len(column_arguments) != len(transparent_values):
+            column_arguments = [None] * len(transparent_values)
+        for trans_value in transparent_values:
             if isinstance(trans_value, RBQLAggregationToken):
                 num_aggregators_found += 1
-                query_context.writer.aggregators.append(query_context.functional_aggregators[trans_value.marker_id])
-                query_context.writer.aggregators[-1].increment(key, trans_value.value)
+                aggregator = query_context.functional_aggregators[trans_value.marker_id]
+                if isinstance(aggregator, ExactQuantileAggregator):
+                    aggregator.share_state_if_possible(writer.aggregators, column_arguments, column_arguments[len(values)])
+                writer.aggregators.append(aggregator)
+                values.append(trans_value.value)
             else:
-                query_context.writer.aggregators.append(ConstGroupVerifier(len(query_context.writer.aggregators)))
-                query_context.writer.aggregators[-1].increment(key, trans_value)
+                writer.aggregators.append(ConstGroupVerifier(len(writer.aggregators)))
+                values.append(trans_value)
         if num_aggregators_found != len(query_context.functional_aggregators):
             raise RbqlParsingError(wrong_aggregation_usage_error) # UT JSON
+        query_context.writer = writer
         query_context.aggregation_stage = 2
-    else:
-        for i, trans_value in enumerate(transparent_values):
-            query_context.writer.aggregators[i].increment(key, trans_value)
-    query_context.writer.aggregation_keys.add(key)
+        if not writer.aggregate(key, values):
+            return False
+        # The layout of the aggregate columns is known now, so the main loop is stopped and the rest of the input is processed by a specialized aggregate loop, see compile_and_run()
+        # Join matches of the current record and UNNEST values would be lost on this switch, so such queries stay in the main loop.
+        query_context.aggregate_loop_requested = query_context.join_map is None and query_context.unnest_list is None
+        return not query_context.aggregate_loop_requested
+    return query_context.writer.aggregate(key, transparent_values)
 
 
 PROCESS_SELECT_COMMON = '''
 __RBQLMP__variables_init_code
 if __RBQLMP__where_expression:
+    __RBQLMP__matched_variables_init_code
     out_fields = __RBQLMP__select_expression
     if query_context.aggregation_stage > 0:
         key = __RBQLMP__aggregation_key_expression
-        select_aggregated(query_context, key, out_fields)
+        if not select_aggregated(query_context, key, out_fields):
+            stop_flag = True
     else:
-        sort_key = __RBQLMP__sort_key_expression
-        if query_context.unnest_list is not None:
-            if not select_unnested(sort_key, out_fields):
-                stop_flag = True
-        else:
-            if not select_simple(query_context, sort_key, out_fields):
-                stop_flag = True
+        __RBQLMP__write_code
+'''
+
+
+# The output writer is bound to write_output local variable before the main loop. It is replaced only by select_aggregated() and after that the records never get to this code.
+WRITE_SELECTED = '''
+if not write_output(__RBQLMP__write_arguments):
+    stop_flag = True
 '''
 
 
-PROCESS_SELECT_SIMPLE = '''
-star_fields = record_a
-__CODE__
+WRITE_SELECTED_OR_UNNESTED = '''
+sort_key = __RBQLMP__sort_key_expression
+if query_context.unnest_list is not None:
+    if not select_unnested(sort_key, out_fields):
+        stop_flag = True
+else:
+    if not select_simple(query_context, sort_key, out_fields):
+        stop_flag = True
 '''
 
 
@@ -656,7 +1562,6 @@ PROCESS_SELECT_JOIN = '''
 join_matches = query_context.join_map.get_rhs(__RBQLMP__lhs_join_var_expression)
 for join_match in join_matches:
     bNR, bNF, record_b = join_match
-    star_fields = record_a + record_b
     __CODE__
     if stop_flag:
         break
@@ -674,9 +1579,10 @@ else:
 up_fields = record_a[:]
 __RBQLMP__variables_init_code
 if len(join_matches) == 1 and (__RBQLMP__where_expression):
+    __RBQLMP__matched_variables_init_code
     NU += 1
     __RBQLMP__update_expressions
-if not query_context.writer.write(up_fields):
+if not write_output(up_fields):
     stop_flag = True
 '''
 
@@ -685,15 +1591,110 @@ PROCESS_UPDATE_SIMPLE = '''
 up_fields = record_a[:]
 __RBQLMP__variables_init_code
 if __RBQLMP__where_expression:
+    __RBQLMP__matched_variables_init_code
     NU += 1
     __RBQLMP__update_expressions
-if not query_context.writer.write(up_fields):
+if not write_output(up_fields):
     stop_flag = True
 '''
 
+PROCESS_RECORD = '''
+try:
+    __CODE__
+except InternalBadKeyError as e:
+    raise RbqlRuntimeError('No "{}" field at record {}'.format(e.bad_key, NR)) # UT JSON
+except InternalBadFieldError as e:
+    raise RbqlRuntimeError('No "a{}" field at record {}'.format(e.bad_idx + 1, NR)) # UT JSON
+except RbqlParsingError:
+    raise
+except Exception as e:
+    if debug_mode:
+        raise
+    if str(e).find('RBQLAggregationToken') != -1:
+        raise RbqlParsingError(wrong_aggregation_usage_error) # UT JSON
+    raise RbqlRuntimeError('At record ' + str(NR) + ', Details: ' + str(e)) # UT JSON
+'''
+
+
+AGGREGATE_GROUPS = '''
+__RBQLMP__variables_init_code
+if __RBQLMP__where_expression:
+    __RBQLMP__matched_variables_init_code
+    group_key = __RBQLMP__aggregation_key_expression
+    group_states = groups.get(group_key)
+    if group_states is None:
+        groups[group_key] = __RBQLMP__init_states_expression
+    else:
+        __RBQLMP__increment_states_code
+    __RBQLMP__size_check_code
+'''
+
+
+CHECK_GROUPS_SIZE = '''
+num_records_since_size_check += 1
+if num_records_since_size_check >= group_by_size_check_interval:
+    num_records_since_size_check = 0
+    writer.check_memory_usage()
+    groups = writer.groups
+'''
+
+
+AGGREGATE_SORTED_GROUPS = '''
+__RBQLMP__variables_init_code
+if __RBQLMP__where_expression:
+    __RBQLMP__matched_variables_init_code
+    group_key = __RBQLMP__aggregation_key_expression
+    if group_key is current_key or group_key == current_key:
+        group_states = current_states
+        __RBQLMP__increment_states_code
+    else:
+        if not writer.aggregate(group_key, __RBQLMP__values_expression):
+            stop_flag = True
+        current_key = writer.current_key
+        current_states = writer.current_states
+'''
+
+
+AGGREGATE_RECORDS = '''
+__RBQLMP__variables_init_code
+if __RBQLMP__where_expression:
+    __RBQLMP__matched_variables_init_code
+    out_fields = __RBQLMP__select_expression
+    if not writer.aggregate(__RBQLMP__aggregation_key_expression, out_fields):
+        stop_flag = True
+'''
+
+
+# Continues the main loop from the record after the first aggregated one. The local variables of the main loop, including the ones defined by the user init code, are copied from main_loop_namespace, so the init code is not executed again.
+AGGREGATE_LOOP_BODY = '''
+def aggregate_loop_for_exec(query_context, main_loop_namespace):
+    __NAMESPACE_INIT_CODE__
+
+    writer = query_context.writer
+    __AGGREGATORS_INIT_CODE__
+
+    stop_flag = False
+    records_batch = records_batch[NR - records_batch_offset:]
+    while True:
+        for record_a in records_batch:
+            NR += 1
+            NF = len(record_a)
+            __PROCESS_RECORD__
+            if stop_flag:
+                break
+        if stop_flag:
+            break
+        records_batch = query_context.input_iterator.get_records(query_context.input_batch_size)
+        if not records_batch:
+            break
+
+aggregate_loop_for_exec(query_context, main_loop_namespace)
+'''
+
+
 # We need dummy_wrapper_for_exec function because otherwise "import" statements won't work as expected if used inside user-defined functions, see: https://github.com/mechatroner/sublime_rainbow_csv/issues/22
 MAIN_LOOP_BODY = '''
-def dummy_wrapper_for_exec(query_context, user_namespace, LIKE, UNNEST, MIN, MAX, COUNT, SUM, AVG, VARIANCE, MEDIAN, ARRAY_AGG, mad_max, mad_min, mad_sum, select_unnested):
+def dummy_wrapper_for_exec(query_context, user_namespace, LIKE, UNNEST, MIN, MAX, COUNT, SUM, AVG, VARIANCE, STDDEV, VAR_SAMP, STDDEV_SAMP, MEDIAN, PERCENTILE_EXACT, APPROX_MEDIAN, PERCENTILE, COUNT_DISTINCT, APPROX_COUNT_DISTINCT, ARRAY_AGG, mad_max, mad_min, mad_sum, select_unnested):
 
     try:
         pass
@@ -713,8 +1714,17 @@ def dummy_wrapper_for_exec(query_context, user_namespace, LIKE, UNNEST, MIN, MAX
     Avg = AVG
     variance = VARIANCE
     Variance = VARIANCE
+    stddev = STDDEV
+    var_samp = VAR_SAMP
+    stddev_samp = STDDEV_SAMP
     median = MEDIAN
     Median = MEDIAN
+    percentile_exact = PERCENTILE_EXACT
+    approx_median = APPROX_MEDIAN
+    percentile = PERCENTILE
+    Percentile = PERCENTILE
+    count_distinct = COUNT_DISTINCT
+    approx_count_distinct = APPROX_COUNT_DISTINCT
     array_agg = ARRAY_AGG
     max = mad_max
     min = mad_min
@@ -722,33 +1732,30 @@ def dummy_wrapper_for_exec(query_context, user_namespace, LIKE, UNNEST, MIN, MAX
 
     udf = user_namespace
 
-    NR = 0
+    __RBQLMP__hoisted_code
+
+    NR = query_context.input_iterator.get_records_offset()
     NU = 0
     stop_flag = False
+    write_output = query_context.writer.write
 
     while not stop_flag:
-        record_a = query_context.input_iterator.get_record()
-        if record_a is None:
+        records_batch = query_context.input_iterator.get_records(query_context.input_batch_size)
+        if not records_batch:
             break
-        NR += 1
-        NF = len(record_a)
-        query_context.unnest_list = None # TODO optimize, don't need to set this every iteration
-        try:
-            __CODE__
-        except InternalBadKeyError as e:
-            raise RbqlRuntimeError('No "{}" field at record {}'.format(e.bad_key, NR)) # UT JSON
-        except InternalBadFieldError as e:
-            raise RbqlRuntimeError('No "a{}" field at record {}'.format(e.bad_idx + 1, NR)) # UT JSON
-        except RbqlParsingError:
-            raise
-        except Exception as e:
-            if debug_mode:
-                raise
-            if str(e).find('RBQLAggregationToken') != -1:
-                raise RbqlParsingError(wrong_aggregation_usage_error) # UT JSON
-            raise RbqlRuntimeError('At record ' + str(NR) + ', Details: ' + str(e)) # UT JSON
-
-dummy_wrapper_for_exec(query_context, user_namespace, LIKE, UNNEST, MIN, MAX, COUNT, SUM, AVG, VARIANCE, MEDIAN, ARRAY_AGG, mad_max, mad_min, mad_sum, select_unnested)
+        records_batch_offset = NR
+        for record_a in records_batch:
+            NR += 1
+            NF = len(record_a)
+            __RBQLMP__unnest_reset_code
+            __PROCESS_RECORD__
+            if stop_flag:
+                break
+
+    if query_context.aggregate_loop_requested:
+        query_context.aggregate_loop_namespace = locals()
+
+dummy_wrapper_for_exec(query_context, user_namespace, LIKE, UNNEST, MIN, MAX, COUNT, SUM, AVG, VARIANCE, STDDEV, VAR_SAMP, STDDEV_SAMP, MEDIAN, PERCENTILE_EXACT, APPROX_MEDIAN, PERCENTILE, COUNT_DISTINCT, APPROX_COUNT_DISTINCT, ARRAY_AGG, mad_max, mad_min, mad_sum, select_unnested)
 '''
 
 
@@ -781,18 +1788,33 @@ def generate_main_loop_code(query_context):
     where_expression = 'True' if query_context.where_expression is None else query_context.where_expression
     aggregation_key_expression = 'None' if query_context.aggregation_key_expression is None else query_context.aggregation_key_expression
     sort_key_expression = 'None' if query_context.sort_key_expression is None else query_context.sort_key_expression
+    # Code which is not needed by the query is not generated at all, because it would be executed for every record
+    loop_expressions = [query_context.user_init_code, query_context.select_expression, query_context.where_expression, query_context.update_expressions, query_context.sort_key_expression, query_context.aggregation_key_expression]
+    uses_unnest = any(e is not None and re.search('unnest', e, flags=re.IGNORECASE) is not None for e in loop_expressions)
     python_code = embed_code(MAIN_LOOP_BODY, '__USER_INIT_CODE__', query_context.user_init_code)
+    python_code = embed_code(python_code, '__RBQLMP__hoisted_code', query_context.hoisted_code if query_context.hoisted_code else 'pass')
+    python_code = embed_code(python_code, '__RBQLMP__unnest_reset_code', 'query_context.unnest_list = None' if uses_unnest else 'pass')
+    python_code = embed_code(python_code, '__PROCESS_RECORD__', PROCESS_RECORD)
     if is_select_query:
+        select_code = PROCESS_SELECT_COMMON
+        if uses_unnest:
+            select_code = embed_code(select_code, '__RBQLMP__write_code', WRITE_SELECTED_OR_UNNESTED)
+            select_code = embed_expression(select_code, '__RBQLMP__sort_key_expression', sort_key_expression)
+        else:
+            select_code = embed_code(select_code, '__RBQLMP__write_code', WRITE_SELECTED)
+            select_code = embed_expression(select_code, '__RBQLMP__write_arguments', 'out_fields' if query_context.sort_key_expression is None else '{}, out_fields'.format(sort_key_expression))
+        if query_context.select_expression.find('star_fields') != -1:
+            select_code = ('star_fields = record_a + record_b\n' if is_join_query else 'star_fields = record_a\n') + select_code
         if is_join_query:
-            python_code = embed_code(embed_code(python_code, '__CODE__', PROCESS_SELECT_JOIN), '__CODE__', PROCESS_SELECT_COMMON)
+            python_code = embed_code(embed_code(python_code, '__CODE__', PROCESS_SELECT_JOIN), '__CODE__', select_code)
             python_code = embed_expression(python_code, '__RBQLMP__lhs_join_var_expression', query_context.lhs_join_var_expression)
         else:
-            python_code = embed_code(embed_code(python_code, '__CODE__', PROCESS_SELECT_SIMPLE), '__CODE__', PROCESS_SELECT_COMMON)
+            python_code = embed_code(python_code, '__CODE__', select_code)
         python_code = embed_code(python_code, '__RBQLMP__variables_init_code', query_context.variables_init_code)
+        python_code = embed_code(python_code, '__RBQLMP__matched_variables_init_code', query_context.matched_variables_init_code)
         python_code = embed_expression(python_code, '__RBQLMP__select_expression', query_context.select_expression)
         python_code = embed_expression(python_code, '__RBQLMP__where_expression', where_expression)
         python_code = embed_expression(python_code, '__RBQLMP__aggregation_key_expression', aggregation_key_expression)
-        python_code = embed_expression(python_code, '__RBQLMP__sort_key_expression', sort_key_expression)
     else:
         if is_join_query:
             python_code = embed_code(python_code, '__CODE__', PROCESS_UPDATE_JOIN)
@@ -800,11 +1822,146 @@ def generate_main_loop_code(query_context):
         else:
             python_code = embed_code(python_code, '__CODE__', PROCESS_UPDATE_SIMPLE)
         python_code = embed_code(python_code, '__RBQLMP__variables_init_code', query_context.variables_init_code)
+        python_code = embed_code(python_code, '__RBQLMP__matched_variables_init_code', query_context.matched_variables_init_code)
         python_code = embed_code(python_code, '__RBQLMP__update_expressions', query_context.update_expressions)
         python_code = embed_expression(python_code, '__RBQLMP__where_expression', where_expression)
     return python_code
 
 
+def tokenize_expression(expression):
+    lines = iter([expression])
+    try:
+        tokens = list(tokenize.generate_tokens(lambda: next(lines, '')))
+    except (tokenize.TokenError, SyntaxError):
+        return None
+    return [t for t in tokens if t[0] not in [tokenize.NEWLINE, tokenize.NL, tokenize.INDENT, tokenize.DEDENT, tokenize.COMMENT, tokenize.ENDMARKER]]
+
+
+def find_closing_bracket(tokens, open_pos):
+    depth = 0
+    for i in range(open_pos, len(tokens)):
+        token_type, token_str = tokens[i][:2]
+        if token_type != tokenize.OP:
+            continue
+        if token_str in ['(', '[', '{']:
+            depth += 1
+        elif token_str in [')', ']', '}']:
+            depth -= 1
+            if depth == 0:
+                return i
+    return None
+
+
+def split_by_top_level_commas(tokens):
+    result = [[]]
+    depth = 0
+    for token in tokens:
+        token_type, token_str = token[:2]
+        if token_type == tokenize.OP:
+            if token_str in ['(', '[', '{']:
+                depth += 1
+            elif token_str in [')', ']', '}']:
+                depth -= 1
+            elif token_str == ',' and depth == 0:
+                result.append([])
+                continue
+        result[-1].append(token)
+    if not len(result[-1]):
+        result.pop() # Trailing comma
+    return result
+
+
+def get_tokens_source(expression, tokens):
+    return expression[tokens[0][2][1]:tokens[-1][3][1]]
+
+
+def parse_select_columns(select_expression):
+    # Splits the translated SELECT expression e.g. `[a1, SUM(int(a2)), PERCENTILE(a3, 0.9)]` into columns.
+    # Returns a list of (function_name, first_argument, column_expression) tuples where function_name and first_argument are None if the column is not a plain function call.
+    # Returns None if the expression can't be split e.g. if it includes star fields.
+    tokens = tokenize_expression(select_expression)
+    if not tokens or any(t[2][0] != 1 or t[3][0] != 1 for t in tokens):
+        return None
+    if tokens[0][1] != '[' or find_closing_bracket(tokens, 0) != len(tokens) - 1:
+        return None
+    result = []
+    for column_tokens in split_by_top_level_commas(tokens[1:-1]):
+        if not len(column_tokens):
+            return None
+        column_expression = get_tokens_source(select_expression, column_tokens)
+        function_name = None
+        first_argument = None
+        if len(column_tokens) > 3 and column_tokens[0][0] == tokenize.NAME and column_tokens[1][1] == '(' and find_closing_bracket(column_tokens, 1) == len(column_tokens) - 1:
+            argument_tokens = split_by_top_level_commas(column_tokens[2:-1])
+            if len(argument_tokens) and len(argument_tokens[0]) and argument_tokens[0][0][1] not in ['*', '**'] and not any(t[1] == '=' for t in argument_tokens[0]):
+                function_name = column_tokens[0][1]
+                first_argument = get_tokens_source(select_expression, argument_tokens[0])
+        result.append((function_name, first_argument, column_expression))
+    return result
+
+
+def generate_aggregate_loop_code(query_context, main_loop_namespace, aggregate_functions):
+    # Generates a loop which passes arguments of aggregate functions directly to the aggregators instead of evaluating the SELECT expression with RBQLAggregationToken-aware functions and then calling the writer.
+    # This is only possible if every aggregate column is a plain call of an aggregate function e.g. `SUM(a2)`, the other queries use a generic loop which calls the writer for each record.
+    writer = query_context.writer
+    aggregators = writer.aggregators
+    columns = parse_select_columns(query_context.select_expression)
+    if columns is not None and len(columns) == len(aggregators):
+        for aggregator, (function_name, first_argument, _column_expression) in zip(aggregators, columns):
+            if not isinstance(aggregator, ConstGroupVerifier) and (first_argument is None or not any(main_loop_namespace.get(function_name) is f for f in aggregate_functions)):
+                columns = None
+                break
+    else:
+        columns = None
+
+    namespace_init_lines = ['{} = main_loop_namespace["{}"]'.format(name, name) for name in sorted(main_loop_namespace.keys()) if name != 'main_loop_namespace']
+    aggregators_init_lines = []
+    if columns is None:
+        record_code = AGGREGATE_RECORDS
+        record_code = embed_expression(record_code, '__RBQLMP__select_expression', query_context.select_expression)
+    else:
+        values = []
+        increment_lines = []
+        for i, aggregator in enumerate(aggregators):
+            function_name, first_argument, column_expression = columns[i]
+            if isinstance(aggregator, CountAggregator):
+                values.append('None')
+                increment_lines.append('group_states[{}] += 1'.format(i))
+                continue
+            value = column_expression if isinstance(aggregator, ConstGroupVerifier) else first_argument
+            values.append(value)
+            aggregators_init_lines.append('init_state_{} = writer.aggregators[{}].init_state'.format(i, i))
+            aggregators_init_lines.append('increment_{} = writer.aggregators[{}].increment'.format(i, i))
+            increment_lines.append('group_states[{}] = increment_{}(group_states[{}], {})'.format(i, i, i, value))
+        if type(writer) is StreamingAggregateWriter:
+            record_code = AGGREGATE_SORTED_GROUPS
+            record_code = embed_expression(record_code, '__RBQLMP__values_expression', '[{}]'.format(', '.join(values)))
+            aggregators_init_lines += ['current_key = writer.current_key', 'current_states = writer.current_states']
+        else:
+            record_code = AGGREGATE_GROUPS
+            init_states = ['1' if isinstance(aggregator, CountAggregator) else 'init_state_{}({})'.format(i, values[i]) for i, aggregator in enumerate(aggregators)]
+            record_code = embed_expression(record_code, '__RBQLMP__init_states_expression', '[{}]'.format(', '.join(init_states)))
+            if writer.memory_budget is not None:
+                record_code = embed_code(record_code, '__RBQLMP__size_check_code', CHECK_GROUPS_SIZE)
+                aggregators_init_lines.append('num_records_since_size_check = writer.num_records_since_size_check')
+            else:
+                record_code = embed_code(record_code, '__RBQLMP__size_check_code', 'pass')
+            aggregators_init_lines.append('groups = writer.groups')
+        record_code = embed_code(record_code, '__RBQLMP__increment_states_code', '\n'.join(increment_lines))
+    record_code = embed_code(record_code, '__RBQLMP__variables_init_code', query_context.variables_init_code)
+    record_code = embed_code(record_code, '__RBQLMP__matched_variables_init_code', query_context.matched_variables_init_code)
+    record_code = embed_expression(record_code, '__RBQLMP__where_expression', 'True' if query_context.where_expression is None else query_context.where_expression)
+    record_code = embed_expression(record_code, '__RBQLMP__aggregation_key_expression', 'None' if query_context.aggregation_key_expression is None else query_context.aggregation_key_expression)
+
+    python_code = embed_code(AGGREGATE_LOOP_BODY, '__NAMESPACE_INIT_CODE__', '\n'.join(namespace_init_lines))
+    python_code = embed_code(python_code, '__AGGREGATORS_INIT_CODE__', '\n'.join(aggregators_init_lines) if len(aggregators_init_lines) else 'pass')
+    python_code = embed_code(python_code, '__PROCESS_RECORD__', PROCESS_RECORD)
+    if query_context.select_expression.find('star_fields') != -1:
+        record_code = 'star_fields = record_a\n' + record_code
+    python_code = embed_code(python_code, '__CODE__', record_code)
+    return python_code
+
+
 builtin_max = max
 builtin_min = min
 builtin_sum = sum
@@ -873,8 +2030,38 @@ def compile_and_run(query_context, user_namespace, unit_test_mode=False):
     def VARIANCE(val):
         return init_aggregator(VarianceAggregator, val) if query_context.aggregation_stage < 2 else val
 
+    def STDDEV(val):
+        return init_aggregator(lambda: VarianceAggregator(take_sqrt=True), val) if query_context.aggregation_stage < 2 else val
+
+    def VAR_SAMP(val):
+        return init_aggregator(lambda: VarianceAggregator(is_sample=True), val) if query_context.aggregation_stage < 2 else val
+
+    def STDDEV_SAMP(val):
+        return init_aggregator(lambda: VarianceAggregator(is_sample=True, take_sqrt=True), val) if query_context.aggregation_stage < 2 else val
+
     def MEDIAN(val):
-        return init_aggregator(MedianAggregator, val) if query_context.aggregation_stage < 2 else val
+        return init_aggregator(ExactQuantileAggregator, val) if query_context.aggregation_stage < 2 else val
+
+    def PERCENTILE_EXACT(val, quantile):
+        if query_context.aggregation_stage >= 2:
+            return val
+        quantile = parse_quantile('PERCENTILE_EXACT', quantile)
+        return init_aggregator(lambda: ExactQuantileAggregator(quantile), val)
+
+    def APPROX_MEDIAN(val):
+        return init_aggregator(lambda: ApproxQuantileAggregator(0.5), val) if query_context.aggregation_stage < 2 else val
+
+    def PERCENTILE(val, quantile):
+        if query_context.aggregation_stage >= 2:
+            return val
+        quantile = parse_quantile('PERCENTILE', quantile)
+        return init_aggregator(lambda: ApproxQuantileAggregator(quantile), val)
+
+    def COUNT_DISTINCT(val):
+        return init_aggregator(CountDistinctAggregator, val) if query_context.aggregation_stage < 2 else val
+
+    def APPROX_COUNT_DISTINCT(val):
+        return init_aggregator(ApproxCountDistinctAggregator, val) if query_context.aggregation_stage < 2 else val
 
     def ARRAY_AGG(val, post_proc=None):
         # TODO consider passing array to output writer
@@ -928,10 +2115,22 @@ def compile_and_run(query_context, user_namespace, unit_test_mode=False):
         # Return these 3 functions to be able to unit test them from outside
         return (mad_max, mad_min, mad_sum)
 
+    if query_context.select_expression is not None:
+        # MEDIAN and PERCENTILE_EXACT aggregators with the same argument expression share their state, see ExactQuantileAggregator
+        columns = parse_select_columns(query_context.select_expression)
+        query_context.select_column_arguments = None if columns is None else [first_argument for _function_name, first_argument, _column_expression in columns]
     main_loop_body = generate_main_loop_code(query_context)
     compiled_main_loop = compile(main_loop_body, '<main loop>', 'exec')
     exec(compiled_main_loop, globals(), locals())
 
+    main_loop_namespace = query_context.aggregate_loop_namespace
+    if main_loop_namespace is not None:
+        query_context.aggregate_loop_namespace = None
+        aggregate_functions = [MIN, MAX, COUNT, SUM, AVG, VARIANCE, STDDEV, VAR_SAMP, STDDEV_SAMP, MEDIAN, PERCENTILE_EXACT, APPROX_MEDIAN, PERCENTILE, COUNT_DISTINCT, APPROX_COUNT_DISTINCT, ARRAY_AGG, mad_max, mad_min, mad_sum]
+        aggregate_loop_body = generate_aggregate_loop_code(query_context, main_loop_namespace, aggregate_functions)
+        compiled_aggregate_loop = compile(aggregate_loop_body, '<aggregate loop>', 'exec')
+        exec(compiled_aggregate_loop, globals(), {'query_context': query_context, 'main_loop_namespace': main_loop_namespace})
+
 
 def exception_to_error_info(e):
     exceptions_type_map = {
@@ -1119,8 +2318,9 @@ def ensure_no_ambiguous_variables(query_text, input_column_names, join_column_na
 def generate_common_init_code(query_text, variable_prefix):
     assert variable_prefix in ['a', 'b']
     result = list()
-    # TODO [PERFORMANCE] do not initialize RBQLRecord if we don't have `a.` or `a[` prefix in the query
-    result.append('{} = RBQLRecord()'.format(variable_prefix))
+    # RBQLRecord is needed for `a.name`, `a["name"]` and `a[1]` variables. False positives e.g. `lambda a: a` only cost an unused object
+    if re.search(r'(?:^|[^_a-zA-Z0-9.]){}(?![_a-zA-Z0-9])'.format(variable_prefix), query_text) is not None:
+        result.append('{} = RBQLRecord()'.format(variable_prefix))
     base_var = 'NR' if variable_prefix == 'a' else 'bNR'
     attr_var = '{}.NR'.format(variable_prefix)
     if query_text.find(attr_var) != -1:
@@ -1130,17 +2330,56 @@ def generate_common_init_code(query_text, variable_prefix):
     return result
 
 
-def generate_init_statements(query_text, variables_map, join_variables_map):
-    code_lines = generate_common_init_code(query_text, 'a')
+def generate_fields_init_code(variables_map, record_name, num_fields_expression, is_nullable):
+    # Fields are read with direct indexing if the record is long enough for all of them, so a single comparison replaces a safe_get() call per variable
+    variables = sorted([(var_info.index, var_name) for var_name, var_info in variables_map.items() if var_info.initialize])
+    if not len(variables):
+        return []
+    max_index = variables[-1][0]
+    null_check = '{} is not None'.format(record_name)
+    code_lines = ['if {}{} > {}:'.format(null_check + ' and ' if is_nullable else '', num_fields_expression, max_index)]
+    code_lines += ['    {} = {}[{}]'.format(var_name, record_name, index) for index, var_name in variables]
+    code_lines.append('else:')
+    for index, var_name in variables:
+        if is_nullable:
+            code_lines.append('    {} = safe_get({}, {}) if {} else None'.format(var_name, record_name, index, null_check))
+        else:
+            code_lines.append('    {} = safe_get({}, {})'.format(var_name, record_name, index))
+    return code_lines
+
+
+def split_where_variables(variables_map, prefix, where_expression):
+    # Returns the variables that can be used by the WHERE expression and the rest of them. False positives e.g. `a1` for `a10` only cost an early initialization.
+    # Fields of `a`/`b` RBQLRecord objects can be accessed with different spellings e.g. `a["x"]`, `a['x']` or `a . x`, so they all go to the first map if the WHERE expression refers to the record at all.
+    if where_expression is None:
+        return (variables_map, dict())
+    where_uses_record = re.search(r'(?:^|[^_a-zA-Z0-9.]){}(?![_a-zA-Z0-9])'.format(prefix), where_expression) is not None
+    where_variables_map = dict()
+    other_variables_map = dict()
     for var_name, var_info in variables_map.items():
-        if var_info.initialize:
-            code_lines.append('{} = safe_get(record_a, {})'.format(var_name, var_info.index))
+        if var_name.startswith(prefix + '.') or var_name.startswith(prefix + '['):
+            is_where_variable = where_uses_record
+        else:
+            is_where_variable = where_expression.find(var_name) != -1
+        if is_where_variable:
+            where_variables_map[var_name] = var_info
+        else:
+            other_variables_map[var_name] = var_info
+    return (where_variables_map, other_variables_map)
+
+
+def generate_init_statements(query_text, variables_map, join_variables_map, where_expression):
+    # Returns two pieces of code: initialization of the variables used by the WHERE expression and of the rest of them which is executed only for the matching records
+    code_lines = generate_common_init_code(query_text, 'a')
+    where_variables_map, other_variables_map = split_where_variables(variables_map, 'a', where_expression)
+    code_lines += generate_fields_init_code(where_variables_map, 'record_a', 'NF', False)
+    matched_code_lines = generate_fields_init_code(other_variables_map, 'record_a', 'NF', False)
     if join_variables_map:
         code_lines += generate_common_init_code(query_text, 'b')
-        for var_name, var_info in join_variables_map.items():
-            if var_info.initialize:
-                code_lines.append('{} = safe_get(record_b, {}) if record_b is not None else None'.format(var_name, var_info.index))
-    return '\n'.join(code_lines)
+        where_variables_map, other_variables_map = split_where_variables(join_variables_map, 'b', where_expression)
+        code_lines += generate_fields_init_code(where_variables_map, 'record_b', 'len(record_b)', True)
+        matched_code_lines += generate_fields_init_code(other_variables_map, 'record_b', 'len(record_b)', True)
+    return ('\n'.join(code_lines), '\n'.join(matched_code_lines))
 
 
 def replace_star_count(aggregate_expression):
@@ -1219,6 +2458,186 @@ def translate_select_expression(select_expression):
     return ('[{}]'.format(translated), translated_for_ast)
 
 
+def get_dotted_name(node):
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        prefix = get_dotted_name(node.value)
+        return None if prefix is None else prefix + '.' + node.attr
+    return None
+
+
+def is_invariant_name(dotted_name, variable_names):
+    if dotted_name is None or dotted_name.split('.')[0] in variable_names:
+        return False
+    return dotted_name in invariant_function_names or (dotted_name.startswith('math.') and dotted_name.count('.') == 1)
+
+
+def is_invariant_node(node, variable_names, allow_mutable=False):
+    # Returns True if the expression doesn't depend on the record and has no side effects. Mutable values e.g. lists are only allowed as function arguments, because a hoisted value is shared by all records.
+    if isinstance(node, ast.Constant):
+        return True
+    if isinstance(node, ast.Tuple) or (allow_mutable and isinstance(node, (ast.List, ast.Set))):
+        return all(is_invariant_node(e, variable_names, allow_mutable) for e in node.elts)
+    if allow_mutable and isinstance(node, ast.Dict):
+        return all(k is not None and is_invariant_node(k, variable_names, True) for k in node.keys) and all(is_invariant_node(v, variable_names, True) for v in node.values)
+    if isinstance(node, ast.Starred):
+        return allow_mutable and is_invariant_node(node.value, variable_names, True)
+    if isinstance(node, ast.BinOp):
+        return is_invariant_node(node.left, variable_names, allow_mutable) and is_invariant_node(node.right, variable_names, allow_mutable)
+    if isinstance(node, ast.UnaryOp):
+        return is_invariant_node(node.operand, variable_names, allow_mutable)
+    if isinstance(node, ast.BoolOp):
+        return all(is_invariant_node(v, variable_names, allow_mutable) for v in node.values)
+    if isinstance(node, ast.Compare):
+        return is_invariant_node(node.left, variable_names, allow_mutable) and all(is_invariant_node(c, variable_names, allow_mutable) for c in node.comparators)
+    if isinstance(node, ast.IfExp):
+        return all(is_invariant_node(n, variable_names, allow_mutable) for n in [node.test, node.body, node.orelse])
+    if isinstance(node, ast.Attribute):
+        dotted_name = get_dotted_name(node)
+        return dotted_name is not None and dotted_name.startswith('math.') and dotted_name.count('.') == 1 and 'math' not in variable_names
+    if isinstance(node, ast.Call):
+        if not is_invariant_name(get_dotted_name(node.func), variable_names):
+            return False
+        return all(is_invariant_node(a, variable_names, True) for a in node.args) and all(is_invariant_node(k.value, variable_names, True) for k in node.keywords)
+    return False
+
+
+def is_constant_membership_test(node):
+    if not isinstance(node, ast.Compare) or len(node.ops) != 1 or not isinstance(node.ops[0], (ast.In, ast.NotIn)):
+        return False
+    container = node.comparators[0]
+    if not isinstance(container, (ast.List, ast.Tuple, ast.Set)) or not len(container.elts):
+        return False
+    for e in container.elts:
+        if isinstance(e, ast.UnaryOp) and isinstance(e.op, (ast.USub, ast.UAdd)):
+            e = e.operand
+        if not isinstance(e, ast.Constant):
+            return False
+    return True
+
+
+class ConstantValuesSet(frozenset):
+    # Replaces the container of `x in [...]` tests with constant values. Unhashable values e.g. lists can't be looked up in a frozenset, they are compared with every value like in the original container
+    def __contains__(self, value):
+        try:
+            return frozenset.__contains__(self, value)
+        except TypeError:
+            return any(v == value for v in self)
+
+
+def find_invariant_subexpressions(node, variable_names, dst_nodes):
+    # Collects the largest invariant subexpressions which contain function calls and the containers of `x in [...]` tests with constant values
+    if is_constant_membership_test(node):
+        dst_nodes.append((node.comparators[0], True))
+        find_invariant_subexpressions(node.left, variable_names, dst_nodes)
+        return
+    if is_invariant_node(node, variable_names) and any(isinstance(n, ast.Call) for n in ast.walk(node)):
+        dst_nodes.append((node, False))
+        return
+    for child in ast.iter_child_nodes(node):
+        find_invariant_subexpressions(child, variable_names, dst_nodes)
+
+
+def hoist_invariant_subexpressions(expression, variable_names, hoisted_expressions):
+    # hoisted_expressions maps (source, is_container) of a hoisted subexpression to the name of the variable that holds its value, identical subexpressions share the variable
+    try:
+        root = ast.parse(expression, mode='eval')
+    except SyntaxError:
+        return expression
+    # Lambda arguments and comprehension variables can shadow the known functions too
+    for node in ast.walk(root):
+        if isinstance(node, ast.arg):
+            variable_names = variable_names | set([node.arg])
+        elif isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            variable_names = variable_names | set([node.id])
+    dst_nodes = []
+    find_invariant_subexpressions(root.body, variable_names, dst_nodes)
+    # Offsets in AST are in UTF-8 bytes
+    encoded_expression = expression.encode('utf-8')
+    for node, is_container in sorted(dst_nodes, key=lambda n: n[0].col_offset, reverse=True):
+        if node.lineno != 1 or node.end_lineno != 1:
+            continue
+        source = ast.get_source_segment(expression, node)
+        if is_container:
+            # A set lookup is O(1) instead of O(N) comparisons
+            source = 'ConstantValuesSet({})'.format(source)
+        var_name = hoisted_expressions.get((source, is_container))
+        if var_name is None:
+            var_name = 'hoisted_value_{}'.format(len(hoisted_expressions))
+            hoisted_expressions[(source, is_container)] = var_name
+        if is_container:
+            replacement = var_name
+        else:
+            # If the evaluation fails e.g. because of invalid arguments the expression is evaluated for every record as before, so that the error is reported only if the expression is actually reached
+            replacement = '({} if {}_ok else {})'.format(var_name, var_name, source)
+        encoded_expression = encoded_expression[:node.col_offset] + replacement.encode('utf-8') + encoded_expression[node.end_col_offset:]
+    return encoded_expression.decode('utf-8')
+
+
+def generate_hoisted_code(hoisted_expressions):
+    code_lines = []
+    for (source, is_container), var_name in iteritems6(hoisted_expressions):
+        if is_container:
+            code_lines.append('{} = {}'.format(var_name, source))
+            continue
+        code_lines += ['try:', '    {} = {}'.format(var_name, source), '    {}_ok = True'.format(var_name), 'except Exception:', '    {}_ok = False'.format(var_name)]
+    return '\n'.join(code_lines)
+
+
+def get_user_defined_names(user_init_code):
+    # Returns the names which the init code binds e.g. with assignments, function definitions and imports or None if they can't be determined
+    try:
+        root = ast.parse(user_init_code)
+    except SyntaxError:
+        return None
+    result = set()
+    for node in ast.walk(root):
+        if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            result.add(node.id)
+        elif isinstance(node, ast.Attribute) and not isinstance(node.ctx, ast.Load):
+            dotted_name = get_dotted_name(node)
+            if dotted_name is not None:
+                result.add(dotted_name.split('.')[0]) # E.g. `re.compile = my_compile`
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            result.add(node.name)
+        elif isinstance(node, ast.arg):
+            result.add(node.arg)
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            result.update(node.names)
+        elif isinstance(node, ast.ExceptHandler) and node.name is not None:
+            result.add(node.name)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                if alias.name == '*':
+                    return None
+                if isinstance(node, ast.Import) and alias.asname is None:
+                    continue # E.g. `import datetime` binds the module itself
+                result.add(alias.asname if alias.asname is not None else alias.name)
+    return result
+
+
+def hoist_invariant_expressions(query_context, variable_names):
+    # Moves subexpressions which don't depend on the record e.g. `datetime.datetime.strptime('2024-01-01', '%Y-%m-%d')` or `re.compile('[0-9]+')` out of the main loop and replaces `x in [...]` tests with constant values with set lookups.
+    # Only calls of known pure functions are hoisted, see invariant_function_names: user functions or e.g. `random.random()` must be evaluated for every record.
+    # Names which the user init code binds are skipped, because they can refer to other functions e.g. `int = my_int_parser`. The user namespace is only reachable as `udf` attributes, so it can't shadow them.
+    # AST nodes don't have end positions before Python 3.8, so the expressions are used as is there.
+    if not hasattr(ast, 'get_source_segment'):
+        return
+    user_defined_names = get_user_defined_names(query_context.user_init_code)
+    if user_defined_names is None:
+        return
+    variable_names = set(variable_names) | user_defined_names
+    hoisted_expressions = OrderedDict()
+    for field_name in ['where_expression', 'select_expression', 'sort_key_expression', 'aggregation_key_expression']:
+        expression = getattr(query_context, field_name)
+        if expression is not None:
+            setattr(query_context, field_name, hoist_invariant_subexpressions(expression, variable_names, hoisted_expressions))
+    if query_context.update_expressions is not None:
+        query_context.update_expressions = '\n'.join([hoist_invariant_subexpressions(e, variable_names, hoisted_expressions) for e in query_context.update_expressions.split('\n')])
+    query_context.hoisted_code = generate_hoisted_code(hoisted_expressions)
+
+
 def separate_string_literals(rbql_expression):
     # The regex is improved expression from here: https://stackoverflow.com/a/14366904/2898283
     string_literals_regex = r'''(\"\"\"|\'\'\'|\"|\')((?<!\\)(\\\\)*\\\1|.)*?\1'''
@@ -1260,11 +2679,11 @@ def separate_actions(statement_groups, rbql_expression):
     # make sure all rbql_expression was separated and SELECT or UPDATE is at the beginning
     rbql_expression = rbql_expression.strip(' ')
     result = dict()
-    # For now support no more than one query modifier per query
-    mobj = re.match('^(.*)  *[Ww][Ii][Tt][Hh] *\(([a-z]{4,20})\) *$', rbql_expression)
+    # Multiple query modifiers are separated by commas e.g. `WITH (header, sorted)`
+    mobj = re.match('^(.*)  *[Ww][Ii][Tt][Hh] *\(([a-z]{4,20}(?: *, *[a-z]{4,20})*)\) *$', rbql_expression)
     if mobj is not None:
         rbql_expression = mobj.group(1)
-        result[WITH] = mobj.group(2)
+        result[WITH] = [modifier.strip() for modifier in mobj.group(2).split(',')]
     ordered_statements = locate_statements(statement_groups, rbql_expression)
     for i in range(len(ordered_statements)):
         statement_start = ordered_statements[i][0]
@@ -1377,14 +2796,15 @@ class HashJoinMap:
     def build(self):
         nr = 0
         while True:
-            fields = self.record_iterator.get_record()
-            if fields is None:
+            records_batch = self.record_iterator.get_records(input_batch_size)
+            if not records_batch:
                 break
-            nr += 1
-            nf = len(fields)
-            self.max_record_len = max(self.max_record_len, nf)
-            key = self.polymorphic_get_key(nr, fields)
-            self.hash_map[key].append((nr, nf, fields))
+            for fields in records_batch:
+                nr += 1
+                nf = len(fields)
+                self.max_record_len = max(self.max_record_len, nf)
+                key = self.polymorphic_get_key(nr, fields)
+                self.hash_map[key].append((nr, nf, fields))
 
 
     def get_join_records(self, key):
@@ -1402,6 +2822,55 @@ def cleanup_query(query_text):
     return ' '.join(rbql_lines).rstrip(';')
 
 
+aggregate_function_names = ['MIN', 'MAX', 'COUNT', 'SUM', 'AVG', 'VARIANCE', 'STDDEV', 'VAR_SAMP', 'STDDEV_SAMP', 'MEDIAN', 'PERCENTILE_EXACT', 'APPROX_MEDIAN', 'PERCENTILE', 'COUNT_DISTINCT', 'APPROX_COUNT_DISTINCT', 'ARRAY_AGG']
+
+
+def has_array_agg_post_processing(format_expression):
+    # Checks if ARRAY_AGG is called with a post-processing function e.g. `ARRAY_AGG(a1, lambda v: sorted(v))`. Such functions are often lambdas which can't be pickled.
+    if re.search(r'(?i)(?:^|[^_a-zA-Z0-9.])ARRAY_AGG *\(', format_expression) is None:
+        return False
+    tokens = tokenize_expression(format_expression)
+    if tokens is None:
+        return True
+    for i in range(1, len(tokens) - 1):
+        if tokens[i][0] == tokenize.NAME and tokens[i][1].upper() == 'ARRAY_AGG' and tokens[i - 1][1] != '.' and tokens[i + 1][1] == '(':
+            closing_pos = find_closing_bracket(tokens, i + 1)
+            if closing_pos is None or len(split_by_top_level_commas(tokens[i + 2:closing_pos])) > 1:
+                return True
+    return False
+
+
+def get_parallel_query_info(query_text):
+    # Checks if the query can be executed independently on consecutive parts of the input table.
+    # Returns None if it can't, otherwise a dict with the list of query modifiers, a flag indicating whether NR variable is used and should have its global meaning
+    # and a flag indicating whether the query has to be executed with query_partial() and merge_partial_results() because it aggregates records (GROUP BY, aggregate functions, DISTINCT).
+    # Otherwise the outputs of the parts can be simply concatenated in the same order.
+    query_text = cleanup_query(query_text)
+    format_expression, _string_literals = separate_string_literals(query_text)
+    format_expression = remove_redundant_input_table_name(format_expression)
+    statement_groups = default_statement_groups[:]
+    statement_groups.remove([FROM])
+    try:
+        rb_actions = separate_actions(statement_groups, format_expression)
+    except RbqlParsingError:
+        return None # Let the regular code path report the error
+    if ORDER_BY in rb_actions:
+        return None
+    if 'sorted' in rb_actions.get(WITH, []):
+        return None # Groups of sorted input are aggregated in a single pass with constant memory
+    if re.search(r'(?:^|[^_a-zA-Z0-9.])NU(?:$|[^_a-zA-Z0-9])', format_expression) is not None:
+        return None # NU is a running counter of updated records
+    # Python builtins min(), max() and sum() are also treated as potential aggregate functions, which is fine because merging handles plain records as well
+    has_aggregate_functions = re.search(r'(?i)(?:^|[^_a-zA-Z0-9.])(?:{}) *\('.format('|'.join(aggregate_function_names)), format_expression) is not None
+    merge_results = SELECT in rb_actions and (GROUP_BY in rb_actions or has_aggregate_functions or 'distinct' in rb_actions[SELECT])
+    if not merge_results and (LIMIT in rb_actions or (SELECT in rb_actions and 'top' in rb_actions[SELECT])):
+        return None # The regular execution stops after reading the first few records anyway
+    if merge_results and has_array_agg_post_processing(format_expression):
+        return None # Partial results of the workers must be pickled, so we reject the query before doing any work
+    uses_record_number = re.search(r'(?:^|[^_a-zA-Z0-9.])NR(?:$|[^_a-zA-Z0-9])', format_expression) is not None
+    return {'query_modifiers': rb_actions.get(WITH, []), 'uses_record_number': uses_record_number, 'merge_results': merge_results}
+
+
 def remove_redundant_input_table_name(query_text):
     query_text = re.sub(' +from +a(?: +|$)', ' ', query_text, flags=re.IGNORECASE).strip()
     query_text = re.sub('^ *update +a +set ', 'update ', query_text, flags=re.IGNORECASE).strip()
@@ -1478,7 +2947,9 @@ def shallow_parse_input_query(query_text, input_iterator, tables_registry, query
         raise RbqlParsingError('Queries without context-based input table must contain "FROM" statement')
 
     if WITH in rb_actions:
-        input_iterator.handle_query_modifier(rb_actions[WITH])
+        for modifier in rb_actions[WITH]:
+            input_iterator.handle_query_modifier(modifier)
+        query_context.input_is_sorted_by_groups = 'sorted' in rb_actions[WITH]
     input_variables_map = input_iterator.get_variables_map(query_text)
 
     if ORDER_BY in rb_actions and UPDATE in rb_actions:
@@ -1501,7 +2972,8 @@ def shallow_parse_input_query(query_text, input_iterator, tables_registry, query
         if join_record_iterator is None:
             raise RbqlParsingError('Unable to find join table: "{}"'.format(rhs_table_id)) # UT JSON CSV
         if WITH in rb_actions:
-            join_record_iterator.handle_query_modifier(rb_actions[WITH])
+            for modifier in rb_actions[WITH]:
+                join_record_iterator.handle_query_modifier(modifier)
         join_variables_map = join_record_iterator.get_variables_map(query_text)
         join_header = join_record_iterator.get_header()
         if input_header is None and join_header is not None:
@@ -1517,15 +2989,16 @@ def shallow_parse_input_query(query_text, input_iterator, tables_registry, query
         query_context.join_map_impl.build()
         query_context.join_map = joiner_type(query_context.join_map_impl)
 
-    query_context.variables_init_code = combine_string_literals(generate_init_statements(format_expression, input_variables_map, join_variables_map), string_literals)
-
-
     if WHERE in rb_actions:
         where_expression = rb_actions[WHERE]['text']
         if re.search(r'[^><!=]=[^=]', where_expression) is not None:
             raise RbqlParsingError('Assignments "=" are not allowed in "WHERE" expressions. For equality test use "=="') # UT JSON
         query_context.where_expression = combine_string_literals(where_expression, string_literals)
 
+    variables_init_code, matched_variables_init_code = generate_init_statements(format_expression, input_variables_map, join_variables_map, query_context.where_expression)
+    query_context.variables_init_code = combine_string_literals(variables_init_code, string_literals)
+    query_context.matched_variables_init_code = combine_string_literals(matched_variables_init_code, string_literals)
+
 
     if UPDATE in rb_actions:
         update_expression = translate_update_expression(rb_actions[UPDATE]['text'], input_variables_map, string_literals)
@@ -1552,6 +3025,9 @@ def shallow_parse_input_query(query_text, input_iterator, tables_registry, query
 
         if query_context.top_count is not None:
             query_context.writer = TopWriter(query_context.writer, query_context.top_count)
+            if ORDER_BY not in rb_actions:
+                # The query can stop early, so we fetch records one by one to avoid reading (and validating) input records past the limit
+                query_context.input_batch_size = 1
         if 'distinct_count' in rb_actions[SELECT]:
             query_context.writer = UniqCountWriter(query_context.writer)
         elif 'distinct' in rb_actions[SELECT]:
@@ -1559,7 +3035,14 @@ def shallow_parse_input_query(query_text, input_iterator, tables_registry, query
 
     if ORDER_BY in rb_actions:
         query_context.sort_key_expression = '({})'.format(combine_string_literals(rb_actions[ORDER_BY]['text'], string_literals))
-        query_context.writer = SortedWriter(query_context.writer, reverse_sort=rb_actions[ORDER_BY]['reverse'])
+        if type(query_context.writer) is TopWriter:
+            # Without DISTINCT only the first top_count sorted records can get to the output
+            query_context.writer = TopSortedWriter(query_context.writer, rb_actions[ORDER_BY]['reverse'], query_context.top_count)
+        else:
+            query_context.writer = SortedWriter(query_context.writer, reverse_sort=rb_actions[ORDER_BY]['reverse'])
+
+    variable_names = set(input_variables_map.keys()) | set(join_variables_map.keys() if join_variables_map else [])
+    hoist_invariant_expressions(query_context, variable_names)
 
 
 def make_inconsistent_num_fields_warning(table_name, inconsistent_records_info):
@@ -1573,15 +3056,87 @@ def make_inconsistent_num_fields_warning(table_name, inconsistent_records_info):
     return warn_msg
 
 
-def query(query_text, input_iterator, output_writer, output_warnings, join_tables_registry=None, user_init_code='', user_namespace=None):
+def query(query_text, input_iterator, output_writer, output_warnings, join_tables_registry=None, user_init_code='', user_namespace=None, pipelined=False):
+    # In pipelined mode input reading and output writing run in background threads, see PipelinedInputIterator and PipelinedOutputWriter.
+    if pipelined:
+        input_iterator = PipelinedInputIterator(input_iterator)
+        output_writer = PipelinedOutputWriter(output_writer)
+    try:
+        query_context = RBQLContext(input_iterator, output_writer, user_init_code)
+        shallow_parse_input_query(query_text, input_iterator, join_tables_registry, query_context)
+        compile_and_run(query_context, user_namespace)
+        if pipelined:
+            # The reader thread can still be running if the query has stopped early e.g. because of LIMIT
+            input_iterator.stop()
+        query_context.writer.finish()
+    finally:
+        if pipelined:
+            input_iterator.stop()
+            output_writer.stop()
+    output_warnings.extend(query_context.input_iterator.get_warnings())
+    if query_context.join_map_impl is not None:
+        output_warnings.extend(query_context.join_map_impl.get_warnings())
+    output_warnings.extend(output_writer.get_warnings())
+
+
+PartialQueryResult = namedtuple('PartialQueryResult', ['header', 'top_count', 'is_distinct', 'writer', 'records'])
+
+
+def query_partial(query_text, input_iterator, output_warnings, join_tables_registry=None, user_init_code='', user_namespace=None):
+    # Runs the query over a part of the input table without producing the output. This is needed for queries with aggregate functions and DISTINCT which can't be executed by concatenating outputs of the parts.
+    # The returned PartialQueryResult is picklable unless ARRAY_AGG has a post-processing function, so it can be passed from a worker process to the main one. Use merge_partial_results() and write_partial_result() to get the final output.
+    output_writer = TableWriter([])
     query_context = RBQLContext(input_iterator, output_writer, user_init_code)
+    query_context.group_by_memory_budget = None # The state is passed to the main process and merged there in memory, so it can't be spilled
     shallow_parse_input_query(query_text, input_iterator, join_tables_registry, query_context)
+    query_context.input_is_sorted_by_groups = False # A group can span multiple parts, so the groups can't be written by the parts
     compile_and_run(query_context, user_namespace)
-    query_context.writer.finish()
     output_warnings.extend(query_context.input_iterator.get_warnings())
     if query_context.join_map_impl is not None:
         output_warnings.extend(query_context.join_map_impl.get_warnings())
-    output_warnings.extend(output_writer.get_warnings())
+    writer = query_context.writer
+    is_distinct = type(writer) is UniqWriter
+    if type(writer) is AggregateWriter or type(writer) is UniqCountWriter:
+        writer.subwriter = None # Only the accumulated state is needed, the rest of the writer chain is rebuilt by write_partial_result()
+        return PartialQueryResult(output_writer.header, query_context.top_count, is_distinct, writer, [])
+    # The records are already deduplicated and truncated by TOP/LIMIT within the part, the same is done again across the parts when they are written
+    return PartialQueryResult(output_writer.header, query_context.top_count, is_distinct, None, output_writer.table)
+
+
+def merge_partial_results(partial_results):
+    # partial_results must be in the order of the input table parts, this keeps the order of the first occurrences of DISTINCT records and the order of values in ARRAY_AGG
+    # Sums of float values (SUM, AVG, VARIANCE) are accumulated in a different order than in a single pass, so they can differ from the single pass result in the last digits
+    merged_writer = None
+    records = []
+    for partial_result in partial_results:
+        if partial_result.writer is None:
+            records.extend(partial_result.records)
+        elif merged_writer is None:
+            merged_writer = partial_result.writer
+        else:
+            if type(merged_writer) is not type(partial_result.writer):
+                raise RbqlRuntimeError(wrong_aggregation_usage_error)
+            merged_writer.merge(partial_result.writer)
+    if merged_writer is not None and len(records):
+        raise RbqlRuntimeError(wrong_aggregation_usage_error) # Some parts have aggregated the records while the others haven't
+    return partial_results[0]._replace(writer=merged_writer, records=records)
+
+
+def write_partial_result(partial_result, output_writer):
+    output_writer.set_header(partial_result.header)
+    writer = output_writer
+    if partial_result.top_count is not None:
+        writer = TopWriter(writer, partial_result.top_count)
+    if partial_result.writer is not None:
+        partial_result.writer.subwriter = writer
+        writer = partial_result.writer
+    else:
+        if partial_result.is_distinct:
+            writer = UniqWriter(writer)
+        for record in partial_result.records:
+            if not writer.write(record):
+                break
+    writer.finish()
 
 
 class RBQLInputIterator:
@@ -1591,10 +3146,24 @@ class RBQLInputIterator:
     def get_record(self):
         raise NotImplementedError('Unable to call the interface method')
 
+    def get_records(self, max_records):
+        # Reimplement if your class can fetch a batch of records faster than by calling get_record() repeatedly.
+        # Should return a list of at most max_records records, the empty list means that the input is exhausted.
+        result = []
+        while len(result) < max_records:
+            record = self.get_record()
+            if record is None:
+                break
+            result.append(record)
+        return result
+
     def handle_query_modifier(self, modifier_name):
         # Reimplement if you need to handle a boolean query modifier that can be used like this: `SELECT * WITH (modifiername)`
         pass
 
+    def get_records_offset(self):
+        return 0 # Reimplement if your class iterates over a part of a larger table: NR of the first returned record would be get_records_offset() + 1
+
     def get_warnings(self):
         return [] # Reimplement if your class can produce warnings
 
@@ -1629,6 +3198,159 @@ class RBQLTableRegistry:
         return [] # Reimplement if your class can produce warnings
 
 
+class PipelinedInputIterator(RBQLInputIterator):
+    # Fetches record batches from the source iterator in a background thread, so that input I/O, decoding and parsing overlap with query evaluation.
+    # The reader thread can read ahead up to pipeline_queue_size batches, so the source iterator can consume (and report warnings for) records past the LIMIT.
+    def __init__(self, source_iterator):
+        self.source_iterator = source_iterator
+        self.batches_queue = queue.Queue(maxsize=pipeline_queue_size)
+        self.reader_thread = None
+        self.stopped = False
+        self.exhausted = False
+        self.current_batch = []
+        self.cursor = 0
+
+    def get_variables_map(self, query_text):
+        return self.source_iterator.get_variables_map(query_text)
+
+    def handle_query_modifier(self, modifier_name):
+        self.source_iterator.handle_query_modifier(modifier_name)
+
+    def get_records_offset(self):
+        return self.source_iterator.get_records_offset()
+
+    def get_header(self):
+        return self.source_iterator.get_header()
+
+    def get_warnings(self):
+        return self.source_iterator.get_warnings()
+
+    def _read_batches(self):
+        while not self.stopped:
+            try:
+                records_batch = self.source_iterator.get_records(input_batch_size)
+            except Exception as e:
+                self.batches_queue.put(([], e))
+                return
+            self.batches_queue.put((records_batch, None))
+            if not records_batch:
+                return
+
+    def get_record(self):
+        records = self.get_records(1)
+        return records[0] if records else None
+
+    def get_records(self, max_records):
+        if self.cursor >= len(self.current_batch):
+            if self.exhausted:
+                return []
+            if self.reader_thread is None:
+                # The thread is started lazily because query modifiers (e.g. WITH (header)) must be applied to the source iterator before the first record is read
+                self.reader_thread = threading.Thread(target=self._read_batches)
+                self.reader_thread.daemon = True
+                self.reader_thread.start()
+            records_batch, exception = self.batches_queue.get()
+            if exception is not None or not records_batch:
+                self.exhausted = True
+                self.current_batch = []
+                if exception is not None:
+                    raise exception
+                return []
+            self.current_batch = records_batch
+            self.cursor = 0
+        if self.cursor == 0 and len(self.current_batch) <= max_records:
+            self.cursor = len(self.current_batch)
+            return self.current_batch
+        result = self.current_batch[self.cursor:self.cursor + max_records]
+        self.cursor += len(result)
+        return result
+
+    def stop(self):
+        if self.reader_thread is None:
+            return
+        self.stopped = True
+        # Draining the queue unblocks the reader thread if it is waiting for a free slot
+        while self.reader_thread.is_alive():
+            try:
+                self.batches_queue.get(timeout=0.01)
+            except queue.Empty:
+                pass
+        self.reader_thread = None
+        self.exhausted = True
+
+
+class PipelinedOutputWriter(RBQLOutputWriter):
+    # Passes batches of output records to a background thread which formats, encodes and writes them with the wrapped writer.
+    # Exceptions from the writer thread are reraised in the main thread on the next write() or finish() call.
+    def __init__(self, subwriter):
+        self.subwriter = subwriter
+        self.batches_queue = queue.Queue(maxsize=pipeline_queue_size)
+        self.writer_thread = None
+        self.pending_records = []
+        self.exception = None
+        self.write_failed = False
+        self.discard_batches = False
+
+    def set_header(self, header):
+        self.subwriter.set_header(header)
+
+    def get_warnings(self):
+        return self.subwriter.get_warnings()
+
+    def _write_batches(self):
+        while True:
+            records_batch = self.batches_queue.get()
+            if records_batch is None:
+                return
+            if self.exception is not None or self.write_failed or self.discard_batches:
+                continue # Keep draining the queue so that the main thread never blocks
+            try:
+                for fields in records_batch:
+                    if not self.subwriter.write(fields):
+                        self.write_failed = True
+                        break
+            except Exception as e:
+                self.exception = e
+
+    def _send_pending_records(self):
+        if self.exception is not None:
+            raise self.exception
+        if self.write_failed:
+            return False
+        if self.writer_thread is None:
+            self.writer_thread = threading.Thread(target=self._write_batches)
+            self.writer_thread.daemon = True
+            self.writer_thread.start()
+        self.batches_queue.put(self.pending_records)
+        self.pending_records = []
+        return True
+
+    def write(self, fields):
+        self.pending_records.append(fields)
+        if len(self.pending_records) >= input_batch_size:
+            return self._send_pending_records()
+        return True
+
+    def _join_writer_thread(self):
+        if self.writer_thread is not None:
+            self.batches_queue.put(None)
+            self.writer_thread.join()
+            self.writer_thread = None
+
+    def finish(self):
+        if self.pending_records:
+            self._send_pending_records()
+        self._join_writer_thread()
+        if self.exception is not None:
+            raise self.exception
+        self.subwriter.finish()
+
+    def stop(self):
+        # Only has effect if the query has failed before finish() was called: unwritten batches are discarded.
+        self.discard_batches = True
+        self._join_writer_thread()
+
+
 class TableIterator(RBQLInputIterator):
     def __init__(self, table, column_names=None, normalize_column_names=True, variable_prefix='a'):
         self.table = table
@@ -1662,6 +3384,15 @@ class TableIterator(RBQLInputIterator):
             self.fields_info[num_fields] = self.NR
         return record
 
+    def get_records(self, max_records):
+        result = self.table[self.NR:self.NR + max_records]
+        for record in result:
+            self.NR += 1
+            num_fields = len(record)
+            if num_fields not in self.fields_info:
+                self.fields_info[num_fields] = self.NR
+        return result
+
     def get_warnings(self):
         if len(self.fields_info) > 1:
             return [make_inconsistent_num_fields_warning('input', self.fields_info)]
@@ -87,7 +87,7 @@ def run_with_python_csv(args, is_interactive):
     warnings = []
     error_type, error_msg = None, None
     try:
-        rbql_csv.query_csv(query, input_path, delim, policy, output_path, out_delim, out_policy, csv_encoding, warnings, with_headers, args.comment_prefix, user_init_code, args.color)
+        rbql_csv.query_csv(query, input_path, delim, policy, output_path, out_delim, out_policy, csv_encoding, warnings, with_headers, args.comment_prefix, user_init_code, args.color, pipelined=args.pipelined, num_workers=args.parallel)
     except Exception as e:
         if args.debug_mode:
             raise
@@ -152,7 +152,8 @@ def is_delimited_table(sampled_lines, delim, policy):
 def sample_lines(src_path, encoding, delim, policy, comment_prefix=None):
     # TODO this should be a dependency-free function, remove sample line functionality from CSVRecordIterator
     result = []
-    with open(src_path, 'rb') as source:
+    source, _is_compressed = rbql_csv.open_input_file(src_path)
+    with source:
         line_iterator = rbql_csv.CSVRecordIterator(source, encoding, delim=delim, policy=policy, line_mode=True, comment_prefix=comment_prefix)
         for _i in polymorphic_xrange(10):
             line = line_iterator.polymorphic_get_row()
@@ -168,6 +169,7 @@ def autodetect_delim_policy(input_path, encoding, comment_prefix=None):
     for delim, policy in autodetection_dialects:
         if is_delimited_table(sampled_lines, delim, policy):
             return (delim, policy)
+    input_path = rbql_csv.strip_compression_extension(input_path)
     if input_path.endswith('.csv'):
         return (',', 'quoted')
     if input_path.endswith('.tsv'):
@@ -176,7 +178,8 @@ def autodetect_delim_policy(input_path, encoding, comment_prefix=None):
 
 
 def sample_records(input_path, delim, policy, encoding, comment_prefix=None):
-    with open(input_path, 'rb') as source:
+    source, _is_compressed = rbql_csv.open_input_file(input_path)
+    with source:
         record_iterator = rbql_csv.CSVRecordIterator(source, encoding, delim=delim, policy=policy, comment_prefix=comment_prefix)
         sampled_records = record_iterator.get_all_records(num_rows=10);
         warnings = record_iterator.get_warnings()
@@ -388,6 +391,8 @@ def csv_main():
     parser.add_argument('--encoding', help='manually set csv encoding', default=rbql_csv.default_csv_encoding, choices=['latin-1', 'utf-8'])
     parser.add_argument('--output', metavar='FILE', help='write output table to FILE instead of stdout')
     parser.add_argument('--color', action='store_true', help='colorize columns in output in non-interactive mode')
+    parser.add_argument('--parallel', metavar='N', type=int, default=1, help='run queries over input FILE in N worker processes. Queries with ORDER BY always run in a single process. Float sums of aggregate functions can differ from the single process result in the last digits')
+    parser.add_argument('--pipelined', action='store_true', help='read input and write output in background threads to overlap I/O with query evaluation')
     parser.add_argument('--version', action='store_true', help='print RBQL version and exit')
     parser.add_argument('--init-source-file', metavar='FILE', help=argparse.SUPPRESS) # Path to init source file to use instead of ~/.rbql_init_source.py
     parser.add_argument('--debug-mode', action='store_true', help=argparse.SUPPRESS) # Run in debug mode
@@ -2,6 +2,8 @@
 from __future__ import unicode_literals
 from __future__ import print_function
 
+import itertools
+
 from . import rbql_engine
 
 
@@ -43,6 +45,11 @@ class DataframeIterator(rbql_engine.RBQLInputIterator):
         # Convert to list because `record` has `Pandas` type.
         return list(record)
 
+    def get_records(self, max_records):
+        result = [list(record) for record in itertools.islice(self.table_itertuples, max_records)]
+        self.NR += len(result)
+        return result
+
     def get_warnings(self):
         return []
 
@@ -53,6 +53,9 @@ class SqliteRecordIterator(rbql_engine.RBQLInputIterator):
         # We need to convert tuple to list here because otherwise we won't be able to concatinate lists in expressions with star `*` operator
         return list(record_tuple)
 
+    def get_records(self, max_records):
+        return [list(record_tuple) for record_tuple in self.cursor.fetchmany(max_records)]
+
     def get_all_records(self, num_rows=None):
         # TODO consider to use TOP in the sqlite query when num_rows is not None
         if num_rows is None:
@@ -442,6 +442,30 @@ class TestSplitMethods(unittest.TestCase):
                 self.assertEqual(expected_fields, test_fields)
 
 
+    def test_c_quoted_splitter(self):
+        if not csv_utils.CQuotedSplitter.supports(','):
+            return
+        splitter = csv_utils.CQuotedSplitter(',')
+        test_lines = ['hello,"world"', ' aaa, " aaa, bbb " , ccc , ddd ', '"a"aa" a,bbb",ccc,ddd', 'hello,world,"', '"aaa ""bbb"", ccc",ddd,', 'a"b,c', '"abc\ndef",ghi']
+        test_lines += [rec[1] for rec in make_random_csv_records_naive()]
+        for line in test_lines:
+            self.assertEqual(csv_utils.split_quoted_str(line, ','), splitter.split(line), msg='\nsrc: {}'.format(line))
+        space_splitter = csv_utils.CQuotedSplitter(' ')
+        for line in ['a "b c" d', '"a b"  c ', ' "a""b" c']:
+            self.assertEqual(csv_utils.split_quoted_str(line, ' '), space_splitter.split(line), msg='\nsrc: {}'.format(line))
+
+
+    def test_make_splitter(self):
+        test_lines = ['', ' ', 'hello', 'hello world', '   a   b  c d ', 'a,b,,c', 'a\tb\t"c\td"', 'a::b::"c::d"', '"a""b", c']
+        test_lines += [rec[1] for rec in make_random_csv_records_naive()]
+        dialects = [(',', 'simple'), ('\t', 'simple'), ('::', 'simple'), (' ', 'whitespace'), (',', 'monocolumn'), (',', 'quoted'), ('\t', 'quoted_rfc'), ('::', 'quoted')]
+        for delim, policy in dialects:
+            for allow_c_parser in [True, False]:
+                splitter = csv_utils.make_splitter(delim, policy, allow_c_parser)
+                for line in test_lines:
+                    self.assertEqual(csv_utils.smart_split(line, delim, policy, False), splitter(line), msg='\nsrc: {}, policy: {}'.format(line, policy))
+
+
 
 class TestLineSplit(unittest.TestCase):
     def test_split_lines_custom(self):
@@ -475,6 +499,32 @@ class TestLineSplit(unittest.TestCase):
             expected_res = src.splitlines()
             self.assertEqual(expected_res, test_res)
 
+    def test_bytes_line_reader(self):
+        source_tokens = ['', 'defghIJKLMN', 'a', 'bc', 'Привет', '☃'] + ['\n', '\r\n', '\r']
+        for test_case in xrange6(1000):
+            src = ''.join(random.choice(source_tokens) for _ in xrange6(random.randint(0, 12)))
+            line_reader = rbql_csv.BytesLineReader(io.BytesIO(src.encode('utf-8')), 'utf-8', chunk_size=random.randint(1, 10))
+            test_res = []
+            while True:
+                line = line_reader.read_line()
+                if line is None:
+                    break
+                test_res.append(line)
+            self.assertEqual(src.splitlines(), test_res)
+
+    def test_split_lines_in_bulk(self):
+        test_cases = list()
+        test_cases.append(('', True, ([], '', None)))
+        test_cases.append(('hello', False, ([], 'hello', None)))
+        test_cases.append(('hello', True, (['hello'], '', None)))
+        test_cases.append(('hello\nworld', False, (['hello'], 'world', '\n')))
+        test_cases.append(('hello\r\nworld\r', False, (['hello'], 'world\r', '\r\n')))
+        test_cases.append(('hello\r\nworld\r', True, (['hello', 'world'], '', '\r\n')))
+        test_cases.append(('hello\rworld\n\n', False, (['hello', 'world', ''], '', '\r')))
+        for tc in test_cases:
+            src, final, expected_res = tc
+            self.assertEqual(expected_res, csv_utils.split_lines_in_bulk(src, final))
+
 
 class TestRecordIterator(unittest.TestCase):
     def test_iterator(self):
@@ -557,6 +607,80 @@ class TestRecordIterator(unittest.TestCase):
             self.assertEqual(table, parsed_table)
 
 
+    def test_batched_records(self):
+        for _test_num in xrange6(100):
+            table = generate_random_decoded_binary_table(10, 10, None)
+            comment_prefix = random.choice(['#', '>>'])
+            if table_has_records_with_comment_prefix(table, comment_prefix):
+                continue
+            delim = random.choice(['\t', ',', ';', '|'])
+            policy = random.choice(['quoted', 'quoted_rfc'])
+            if policy == 'quoted':
+                table = [[f.replace('\r', '').replace('\n', '') for f in record] for record in table]
+            csv_data = table_to_csv_string_random(table, delim, policy, comment_prefix=comment_prefix)
+            normalize_newlines_in_fields(table)
+            stream, encoding = string_to_randomly_encoded_stream(csv_data)
+            record_iterator = rbql_csv.CSVRecordIterator(stream, encoding, delim=delim, policy=policy, comment_prefix=comment_prefix, has_header=random.choice([True, False]))
+            parsed_table = []
+            while True:
+                records_batch = record_iterator.get_records(random.randint(1, 5))
+                if not records_batch:
+                    break
+                parsed_table.extend(records_batch)
+            stream.close()
+            self.assertEqual(table[1:] if record_iterator.has_header else table, parsed_table)
+
+            table_iterator = rbql_engine.TableIterator(table)
+            self.assertEqual(table, table_iterator.get_records(random.randint(1, 5)) + table_iterator.get_records(len(table)))
+            self.assertEqual([], table_iterator.get_records(1))
+
+        for csv_data in ['', '# comment\n# another comment\n']:
+            for has_header in [True, False]:
+                record_iterator = rbql_csv.CSVRecordIterator(io.BytesIO(csv_data.encode('utf-8')), 'utf-8', delim=',', policy='quoted', comment_prefix='#', has_header=has_header)
+                self.assertEqual([], record_iterator.get_records(5))
+                record_iterator = rbql_csv.CSVRecordIterator(io.BytesIO(csv_data.encode('utf-8')), 'utf-8', delim=',', policy='quoted', comment_prefix='#', has_header=has_header)
+                self.assertEqual([], record_iterator.get_all_records())
+            output_table = []
+            rbql_engine.query('select a1', rbql_csv.CSVRecordIterator(io.BytesIO(csv_data.encode('utf-8')), 'utf-8', delim=',', policy='quoted', comment_prefix='#'), rbql_engine.TableWriter(output_table), [])
+            self.assertEqual([], output_table)
+
+
+    def test_mmap_line_reader(self):
+        tmp_path = os.path.join(tempfile.gettempdir(), 'rbql_mmap_test_{}_{}.csv'.format(os.getpid(), random.randint(1, 100000000)))
+        try:
+            for _test_num in xrange6(100):
+                table = generate_random_unicode_table(10, 10, ['\r', '\n'])
+                delim = random.choice(['\t', ',', ';', '|'])
+                policy = 'quoted' if find_in_table(table, delim) else random.choice(['quoted', 'simple'])
+                csv_data = table_to_csv_string_random(table, delim, policy)
+                with open(tmp_path, 'wb') as dst:
+                    dst.write(csv_data.encode('utf-8'))
+                with open(tmp_path, 'rb') as src:
+                    record_iterator = rbql_csv.CSVRecordIterator(src, 'utf-8', delim=delim, policy=policy, use_mmap=True)
+                    self.assertTrue(isinstance(record_iterator.line_reader, rbql_csv.MmapLineReader))
+                    record_iterator.line_reader.block_size = random.randint(1, 50)
+                    parsed_table = record_iterator.get_all_records()
+                self.assertEqual(table, parsed_table)
+
+                encoded_data = csv_data.encode('utf-8')
+                split_offset = encoded_data.find(b'\n', random.randint(0, len(encoded_data))) + 1
+                if split_offset > 0:
+                    with open(tmp_path, 'rb') as src:
+                        head_lines = rbql_csv.MmapLineReader(src, 'utf-8', end_offset=split_offset)
+                        tail_lines = rbql_csv.MmapLineReader(src, 'utf-8', start_offset=split_offset)
+                        lines = []
+                        for line_reader in [head_lines, tail_lines]:
+                            while True:
+                                line = line_reader.read_line()
+                                if line is None:
+                                    break
+                                lines.append(line)
+                    self.assertEqual(csv_utils.split_lines_in_bulk(csv_data, final=True)[0], lines)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
     def test_multiline_fields(self):
         data_lines = []
         data_lines.append('foo, bar,aaa')
@@ -672,6 +796,40 @@ class TestRecordIterator(unittest.TestCase):
         expected_warnings = ['None values in output were replaced by empty strings', 'Some output fields contain separator']
         self.assertEqual(expected_warnings, actual_warnings)
 
+        for policy in ['simple', 'quoted', 'quoted_rfc']:
+            writer_stream = io.StringIO()
+            writer = rbql_csv.CSVWriter(writer_stream, False, encoding, delim, policy, '\n')
+            writer._write_all([[], ['hello'], []])
+            self.assertEqual('\nhello\n\n', writer_stream.getvalue())
+            self.assertEqual([], writer.get_warnings())
+
+
+    def test_quoted_output_formatting(self):
+        for _test_num in xrange6(1000):
+            delim = random.choice([',', ';', 'ab', 'aa', ':=)'])
+            policy = random.choice(['quoted', 'quoted_rfc'])
+            fields = [''.join([random.choice(['a', 'b', ',', '"', ':', '=', ')', '\n', '\r', 'x']) for _i in xrange6(natural_random(0, 5))]) for _f in xrange6(random.randint(1, 5))]
+            quote_function = csv_utils.quote_field if policy == 'quoted' else csv_utils.rfc_quote_field
+            expected_data = delim.join([quote_function(f, delim) for f in fields]) + '\n'
+            writer_stream = io.StringIO()
+            writer = rbql_csv.CSVWriter(writer_stream, False, None, delim, policy, '\n')
+            writer._write_all([fields])
+            self.assertEqual(expected_data, writer_stream.getvalue())
+
+
+    def test_pipe_output_flushing(self):
+        read_fd, write_fd = os.pipe()
+        with os.fdopen(read_fd, 'rb') as reader_end, os.fdopen(write_fd, 'wb') as writer_end:
+            writer = rbql_csv.CSVWriter(writer_end, False, 'utf-8', ',', 'simple', '\n')
+            self.assertEqual('pipe', writer.stream_kind)
+            # The first records should reach the reader right away, without waiting for the writer to finish
+            writer.write(['hello', 'world'])
+            self.assertEqual(b'hello,world\n', reader_end.read(12))
+            for i in xrange6(10):
+                writer.write([str(i)])
+            self.assertTrue(writer.flush_threshold > 1)
+        self.assertEqual('file', rbql_csv.CSVWriter(io.BytesIO(), False, 'utf-8', ',', 'simple').stream_kind)
+
 
     def test_utf_decoding_errors(self):
         table = [['hello', u'\x80\x81\xffThis unicode string encoded as latin-1 is not a valid utf-8\xaa\xbb\xcc'], ['hello', 'world']]
@@ -848,6 +1006,350 @@ class TestRBQLSimple(unittest.TestCase):
             self._do_test_random_headers()
 
 
+    def test_pipelined_query(self):
+        input_table = [[str(i), str(i % 7)] for i in range(5000)]
+        queries = ['select a1, a2 where int(a1) % 3 == 0', 'select top 10 a2', 'select a2, count(*) group by a2', 'update set a2 = a1 where NR > 4990', 'select distinct a2 order by a2']
+        for query in queries:
+            expected_table = []
+            rbql.query(query, rbql_engine.TableIterator(input_table), rbql_engine.TableWriter(expected_table), [])
+            output_table = []
+            warnings = []
+            rbql.query(query, rbql_engine.TableIterator(input_table), rbql_engine.TableWriter(output_table), warnings, pipelined=True)
+            self.assertEqual(expected_table, output_table)
+            self.assertEqual([], warnings)
+
+        with self.assertRaises(Exception) as cm:
+            rbql.query('select int(a2) + 1', rbql_engine.TableIterator(input_table + [['hello', 'world']]), rbql_engine.TableWriter([]), [], pipelined=True)
+        self.assertTrue(str(cm.exception).find('At record 5001') != -1)
+
+
+    def test_external_sort(self):
+        input_table = [[str(i), str(random.randint(0, 20)), random.choice(['a', 'b', 'c'])] for i in range(3000)]
+        queries = ['select * order by int(a2)', 'select * order by a3, int(a2) desc', 'select a1 order by a3 desc', 'select top 7 distinct a3, a2 order by a3, a2', 'select distinct a3, a1 order by a2 desc limit 100']
+        expected_tables = []
+        for query in queries:
+            expected_tables.append([])
+            rbql.query(query, rbql_engine.TableIterator(input_table), rbql_engine.TableWriter(expected_tables[-1]), [])
+        saved_sort_memory_budget = rbql_engine.sort_memory_budget
+        rbql_engine.sort_memory_budget = 10000
+        try:
+            for query, expected_table in zip(queries, expected_tables):
+                output_table = []
+                query_context = rbql_engine.RBQLContext(rbql_engine.TableIterator(input_table), rbql_engine.TableWriter(output_table), '')
+                rbql_engine.shallow_parse_input_query(query, query_context.input_iterator, None, query_context)
+                sorted_writer = query_context.writer
+                rbql_engine.compile_and_run(query_context, None)
+                self.assertTrue(len(sorted_writer.sorted_runs) > 2)
+                query_context.writer.finish()
+                self.assertEqual(expected_table, output_table, 'Query: {}'.format(query))
+        finally:
+            rbql_engine.sort_memory_budget = saved_sort_memory_budget
+
+
+    def test_top_sorted_writer(self):
+        input_table = [[str(i), str(random.randint(0, 20)), random.choice(['a', 'b', 'c'])] for i in range(3000)]
+        for reverse_sort in [False, True]:
+            for top_count in [0, 1, 5, 100, 5000]:
+                sorted_table = []
+                sorted_writer = rbql_engine.SortedWriter(rbql_engine.TopWriter(rbql_engine.TableWriter(sorted_table), top_count), reverse_sort)
+                top_table = []
+                top_writer = rbql_engine.TopSortedWriter(rbql_engine.TopWriter(rbql_engine.TableWriter(top_table), top_count), reverse_sort, top_count)
+                for record in input_table:
+                    sort_key_value = (record[2], int(record[1]))
+                    sorted_writer.write(sort_key_value, record)
+                    top_writer.write(sort_key_value, record)
+                sorted_writer.finish()
+                top_writer.finish()
+                self.assertEqual(sorted_table, top_table)
+                self.assertTrue(len(top_writer.heap) <= top_count)
+        output_table = []
+        rbql.query_table('select top 3 a1 order by a2 desc', [['1', 'x'], ['2', 'z'], ['3', 'y'], ['4', 'z']], output_table, [])
+        self.assertEqual([['4'], ['2'], ['3']], output_table)
+
+
+    def test_approx_quantiles(self):
+        values = list(range(20000))
+        random.shuffle(values)
+        input_table = [[str(v % 2), str(v)] for v in values]
+        output_table = []
+        rbql.query_table('select a1, approx_median(a2), percentile(a2, 0.9), percentile(a2, 0) group by a1', input_table, output_table, [])
+        self.assertEqual(['0', '1'], sorted([r[0] for r in output_table]))
+        for row in output_table:
+            self.assertTrue(abs(row[1] - 10000) < 300)
+            self.assertTrue(abs(row[2] - 18000) < 300)
+            self.assertTrue(row[3] < 300)
+
+        sketch = rbql_engine.QuantileSketch(rbql_engine.quantile_sketch_k)
+        for v in values[:10000]:
+            sketch.update(v)
+        other_sketch = rbql_engine.QuantileSketch(rbql_engine.quantile_sketch_k)
+        for v in values[10000:]:
+            other_sketch.update(v)
+        sketch.merge(other_sketch)
+        self.assertTrue(sketch.size < rbql_engine.quantile_sketch_k * 3)
+        self.assertTrue(abs(sketch.get_quantile(0.25) - 5000) < 300)
+
+        output_table = []
+        rbql.query_table('select approx_median(a1), percentile(a1, 0.25), percentile(a1, 1)', [['4'], ['1'], ['3'], ['2']], output_table, [])
+        self.assertEqual([[2, 1, 4]], output_table)
+        with self.assertRaises(Exception) as cm:
+            rbql.query_table('select percentile(a1, 99)', [['4']], [], [])
+        self.assertTrue(str(cm.exception).find('PERCENTILE quantile must be a number between 0 and 1') != -1)
+
+
+    def test_variance(self):
+        input_table = [[str(i % 2), str(1e9 + (i % 7) * 0.1)] for i in range(7000)]
+        output_table = []
+        rbql.query_table('select a1, variance(a2), stddev(a2), var_samp(a2), stddev_samp(a2) group by a1', input_table, output_table, [])
+        for row in output_table:
+            self.assertAlmostEqual(0.04, row[1], places=6)
+            self.assertAlmostEqual(0.2, row[2], places=6)
+            self.assertAlmostEqual(0.04 * 3500 / 3499, row[3], places=6)
+            self.assertAlmostEqual((0.04 * 3500 / 3499) ** 0.5, row[4], places=6)
+
+        query = 'select a1, variance(a2), var_samp(a2) group by a1'
+        expected_table = []
+        rbql.query_table(query, input_table, expected_table, [])
+        partial_results = [rbql_engine.query_partial(query, rbql_engine.TableIterator(part), []) for part in [input_table[:1001], input_table[1001:]]]
+        output_table = []
+        rbql_engine.write_partial_result(rbql_engine.merge_partial_results(partial_results), rbql_engine.TableWriter(output_table))
+        for expected_row, output_row in zip(expected_table, output_table):
+            self.assertEqual(expected_row[0], output_row[0])
+            self.assertAlmostEqual(expected_row[1], output_row[1], places=9)
+            self.assertAlmostEqual(expected_row[2], output_row[2], places=9)
+
+        output_table = []
+        rbql.query_table('select variance(a1), var_samp(a1), stddev_samp(a1)', [['5']], output_table, [])
+        self.assertEqual([[0.0, None, None]], output_table)
+
+
+    def test_count_distinct(self):
+        input_table = [[str(i % 3), str(i % 1000 if i % 3 == 0 else i), str(i % 7)] for i in range(30000)]
+        output_table = []
+        rbql.query_table('select a1, count_distinct(a2), approx_count_distinct(a2), approx_count_distinct(a3) group by a1', input_table, output_table, [])
+        output_table.sort()
+        self.assertEqual(['0', 1000, 7], [output_table[0][i] for i in [0, 1, 3]])
+        self.assertTrue(abs(output_table[0][2] - 1000) < 30)
+        for row in output_table[1:]:
+            self.assertEqual(10000, row[1])
+            self.assertTrue(abs(row[2] - 10000) < 300)
+            self.assertEqual(7, row[3])
+
+        parts = [input_table[:10000], input_table[10000:]]
+        query = 'select a1, count_distinct(a2), approx_count_distinct(a2) group by a1'
+        expected_table = []
+        rbql.query_table(query, input_table, expected_table, [])
+        partial_results = [rbql_engine.query_partial(query, rbql_engine.TableIterator(part), []) for part in parts]
+        output_table = []
+        rbql_engine.write_partial_result(rbql_engine.merge_partial_results(partial_results), rbql_engine.TableWriter(output_table))
+        self.assertEqual(expected_table, output_table)
+
+
+    def test_exact_quantiles(self):
+        input_table = [[str(i % 3), str(random.randint(-100, 100)) if i != 500 else '0.5', str(i)] for i in range(3000)]
+        query = 'select a1, median(a2), percentile_exact(a2, 0.9), percentile_exact(a2, 0), percentile_exact(a2 if NR < 2000 else a3, 0.3), median(a3) group by a1'
+        output_table = []
+        rbql.query_table(query, input_table, output_table, [])
+        for row in output_table:
+            values = sorted([float(r[1]) for r in input_table if r[0] == row[0]])
+            mixed_values = sorted([float(r[1]) if int(r[2]) < 1999 else float(r[2]) for r in input_table if r[0] == row[0]])
+            self.assertEqual((values[499] + values[500]) / 2.0, row[1])
+            self.assertEqual(values[899], row[2])
+            self.assertEqual(values[0], row[3])
+            self.assertEqual(mixed_values[299], row[4])
+        self.assertEqual(0, rbql_engine.select_kth_smallest([3, 1, 2, 0, 1] * 1000, 0))
+        self.assertEqual(2, rbql_engine.select_kth_smallest([3, 1, 2, 0, 1] * 1000, 3500))
+
+        query_context = rbql_engine.RBQLContext(rbql_engine.TableIterator(input_table), rbql_engine.TableWriter([]), '')
+        rbql_engine.shallow_parse_input_query('select median(a2), percentile_exact(a2, 0.9), percentile_exact(a3, 0.9)', query_context.input_iterator, None, query_context)
+        rbql_engine.compile_and_run(query_context, None)
+        states = query_context.writer.groups[None]
+        self.assertTrue(states[1] is states[0])
+        self.assertTrue(states[2] is not states[0])
+
+        # Sharing is decided by the argument expression, not by the identity of the values in the first record which are distinct int objects here
+        query_context = rbql_engine.RBQLContext(rbql_engine.TableIterator(input_table[1000:]), rbql_engine.TableWriter([]), '')
+        rbql_engine.shallow_parse_input_query('select median(int(a3)), percentile_exact(int(a3), 0.9), percentile_exact(int(a3) + 0, 0.9)', query_context.input_iterator, None, query_context)
+        rbql_engine.compile_and_run(query_context, None)
+        states = query_context.writer.groups[None]
+        self.assertTrue(states[1] is states[0])
+        self.assertTrue(states[2] is not states[0])
+
+        # The same expression can give different values, then the sharer gets its own copy of the state
+        source = rbql_engine.ExactQuantileAggregator()
+        sharer = rbql_engine.ExactQuantileAggregator(0.9)
+        source.share_state_if_possible([], ['f(a1)'], 'f(a1)')
+        sharer.share_state_if_possible([source], ['f(a1)', 'f(a1)'], 'f(a1)')
+        source_state = source.init_state('1')
+        sharer_state = sharer.init_state('1')
+        self.assertTrue(sharer_state is source_state)
+        source_state = source.increment(source_state, '2')
+        sharer_state = sharer.increment(sharer_state, '3')
+        self.assertTrue(sharer_state is not source_state)
+        self.assertEqual(1.5, source.get_final(source_state))
+        self.assertEqual(3, sharer.get_final(sharer_state))
+
+        # Sharing of the values can differ between parts of the input
+        parts = [input_table[:1000], input_table[1000:2500], input_table[2500:]]
+        query = 'select a1, median(a2), percentile_exact(a2 if int(a3) < 1200 else a3, 0.5), percentile_exact(a2, 0.25) group by a1'
+        expected_table = []
+        rbql.query_table(query, input_table, expected_table, [])
+        partial_results = [rbql_engine.query_partial(query, rbql_engine.TableIterator(part), []) for part in parts]
+        output_table = []
+        rbql_engine.write_partial_result(rbql_engine.merge_partial_results(partial_results), rbql_engine.TableWriter(output_table))
+        self.assertEqual(expected_table, output_table)
+
+
+    def test_group_by_spill(self):
+        input_table = [[str(random.randint(0, 300)), str(random.randint(-50, 50)), str(i), random.choice(['a', 'b'])] for i in range(20000)]
+        queries = [
+            'select a1, count(*), min(a2), max(a2), sum(a2), avg(a2), median(a2), percentile_exact(a2, 0.9), percentile_exact(a2 if int(a3) < 12000 else a3, 0.3), count_distinct(a2), array_agg(a3, lambda v: ",".join(v)) group by a1',
+            'select a4, a1, array_agg(a2) group by a4, a1 limit 20',
+        ]
+        for query in queries:
+            expected_table = []
+            rbql.query_table(query, input_table, expected_table, [])
+            old_settings = (rbql_engine.group_by_memory_budget, rbql_engine.group_by_size_check_interval, rbql_engine.group_by_spill_partitions)
+            rbql_engine.group_by_memory_budget, rbql_engine.group_by_size_check_interval, rbql_engine.group_by_spill_partitions = 1, 1000, 4
+            try:
+                output_table = []
+                rbql.query_table(query, input_table, output_table, [])
+            finally:
+                rbql_engine.group_by_memory_budget, rbql_engine.group_by_size_check_interval, rbql_engine.group_by_spill_partitions = old_settings
+            self.assertEqual(expected_table, output_table)
+
+
+    def test_sorted_groups(self):
+        input_table = sorted([['{:03d}'.format(random.randint(0, 300)), str(random.randint(-50, 50)), str(i)] for i in range(5000)])
+        query = 'select a1, count(*), sum(a2), median(a2), percentile_exact(a2, 0.9), count_distinct(a2), array_agg(a3, lambda v: len(v)) group by a1'
+        expected_table = []
+        rbql.query_table(query, input_table, expected_table, [])
+        output_table = []
+        rbql.query_table(query + ' with (sorted)', input_table, output_table, [])
+        self.assertEqual(expected_table, output_table)
+
+        output_table = []
+        rbql.query_table('select a1, count(*) group by a1 limit 2 with (sorted)', [['a'], ['a'], ['b'], ['c'], ['d'], ['a']], output_table, [])
+        self.assertEqual([['a', 2], ['b', 1]], output_table)
+
+        with self.assertRaises(Exception) as cm:
+            rbql.query_table('select a1, count(*) group by a1 with (sorted)', [['a'], ['b'], ['a']], [], [])
+        self.assertTrue(str(cm.exception).find('At record 3, Details: Input is not sorted by the GROUP BY key as required by "WITH (sorted)": group "a" comes after group "b"') != -1)
+
+
+    def test_generated_main_loop(self):
+        input_table = [['1', 'a', 'x'], ['2', 'b'], ['3', 'c', 'x', 'extra']]
+        query_context = rbql_engine.RBQLContext(rbql_engine.TableIterator(input_table), rbql_engine.TableWriter([]), '')
+        rbql_engine.shallow_parse_input_query("select a1, a2 where a3 == 'x'", query_context.input_iterator, None, query_context)
+        python_code = rbql_engine.generate_main_loop_code(query_context)
+        for unneeded_code in ['RBQLRecord()', 'star_fields', 'unnest_list']:
+            self.assertEqual(-1, python_code.find(unneeded_code))
+        # Only the variables of the WHERE expression are initialized before it
+        self.assertTrue(-1 < python_code.find('a3 = record_a[2]') < python_code.find("if a3 == 'x':") < python_code.find('a1 = record_a[0]'))
+
+        output_table = []
+        rbql.query_table("select a1, a2, a3 where a3 != 'y'", input_table, output_table, [])
+        self.assertEqual([['1', 'a', 'x'], ['2', 'b', None], ['3', 'c', 'x']], output_table)
+        output_table = []
+        rbql.query_table("select a1, a[2], * where a3 != 'y'", input_table, output_table, [])
+        self.assertEqual([['1', 'a', '1', 'a', 'x'], ['2', 'b', '2', 'b'], ['3', 'c', '3', 'c', 'x', 'extra']], output_table)
+
+
+    def test_hoisted_expressions(self):
+        # Hoisting needs ast.get_source_segment() which is available since Python 3.8, the query results must be the same without it.
+        # python_version is not used here because it is a float and e.g. 3.10 would be compared as 3.1
+        hoisting_supported = sys.version_info[:2] >= (3, 8)
+        input_table = [['1', 'x', '2024-02-01'], ['2', 'y', '2023-12-31'], ['3', 'z', '2024-05-05']]
+        query = "select a1, re.compile('[0-9]').match(a1) is not None, random.random() < 2 where a2 in ['x', 'z', -1] and datetime.datetime.strptime(a3, '%Y-%m-%d') > datetime.datetime.strptime('2024-01-01', '%Y-%m-%d')"
+        query_context = rbql_engine.RBQLContext(rbql_engine.TableIterator(input_table), rbql_engine.TableWriter([]), '')
+        rbql_engine.shallow_parse_input_query(query, query_context.input_iterator, None, query_context)
+        if hoisting_supported:
+            for hoisted_expression in ["ConstantValuesSet(['x', 'z', -1])", "datetime.datetime.strptime('2024-01-01', '%Y-%m-%d')", "re.compile('[0-9]')"]:
+                self.assertNotEqual(-1, query_context.hoisted_code.find(hoisted_expression))
+            self.assertEqual(-1, query_context.hoisted_code.find('random'))
+            self.assertEqual(-1, query_context.hoisted_code.find('a3'))
+        else:
+            self.assertEqual(None, query_context.hoisted_code)
+        output_table = []
+        rbql.query_table(query, input_table, output_table, [])
+        self.assertEqual([['1', True, True], ['3', True, True]], output_table)
+
+        # Hoisted expressions which fail are evaluated for every record, so the error is only reported if they are reached
+        output_table = []
+        rbql.query_table("select a1 where a1 == '1' or int('bad') > 0", input_table[:1], output_table, [])
+        self.assertEqual([['1']], output_table)
+        with self.assertRaises(Exception) as cm:
+            rbql.query_table("select a1, int('bad') if a1 == '2' else 0", input_table, [], [])
+        self.assertTrue(str(cm.exception).find('At record 2, Details: invalid literal for int()') != -1)
+
+        # Unhashable values can't be looked up in a set, they are compared with every constant value
+        output_table = []
+        rbql.query_table('select a2 where a1 in [1, 2, 3]', [[[1, 2], 'x'], [3, 'y'], [[3], 'z']], output_table, [])
+        self.assertEqual([['y']], output_table)
+        output_table = []
+        rbql.query_table("select a1 where a1.split(',') not in [1, 'x', ('1', '2')]", [['1,2'], ['x']], output_table, [])
+        self.assertEqual([['1,2'], ['x']], output_table)
+
+        # Names bound by the init code or by the expression itself can refer to functions with side effects or to other functions
+        init_code = 'import datetime\nnum_calls = [0]\ndef abs(v):\n    num_calls[0] += 1\n    return num_calls[0]'
+        query_context = rbql_engine.RBQLContext(rbql_engine.TableIterator(input_table), rbql_engine.TableWriter([]), init_code)
+        rbql_engine.shallow_parse_input_query("select abs(-1), (lambda int: int('5'))(lambda v: v + a1), datetime.date(2024, 1, 1)", query_context.input_iterator, None, query_context)
+        if hoisting_supported:
+            self.assertEqual("try:\n    hoisted_value_0 = datetime.date(2024, 1, 1)\n    hoisted_value_0_ok = True\nexcept Exception:\n    hoisted_value_0_ok = False", query_context.hoisted_code)
+        output_table = []
+        rbql.query_table("select abs(-1), (lambda int: int('5'))(lambda v: v + a1)", input_table, output_table, [], user_init_code=init_code)
+        self.assertEqual([[1, '51'], [2, '52'], [3, '53']], output_table)
+        if not hoisting_supported:
+            return
+        self.assertEqual(None, rbql_engine.get_user_defined_names('from math import *'))
+        self.assertEqual(set(['x', 'y', 're', 'f', 'v', 'e', 'dt', 'Foo']), rbql_engine.get_user_defined_names('import math\nimport datetime as dt\nx, y = 1, 2\nre.compile = None\ndef f(v):\n    pass\nclass Foo:\n    pass\ntry:\n    pass\nexcept Exception as e:\n    pass'))
+
+
+    def test_aggregate_loop(self):
+        self.assertEqual([(None, None, 'a1'), ('SUM', 'int(a2)', 'SUM(int(a2))'), ('PERCENTILE', 'a3', 'PERCENTILE(a3, [0.5, 1][0])'), (None, None, 'max(a1) + 1'), ('foo', 'a1 == ","', 'foo(a1 == ",", x=1)')], rbql_engine.parse_select_columns('[a1, SUM(int(a2)), PERCENTILE(a3, [0.5, 1][0]), max(a1) + 1, foo(a1 == ",", x=1),]'))
+        self.assertEqual(None, rbql_engine.parse_select_columns('[a1] + star_fields + [COUNT(1)]'))
+
+        input_table = [[str(random.randint(0, 30)), str(random.randint(-50, 50)), str(i)] for i in range(3000)]
+        init_code = 'def add_suffix(v):\n    return v + "!"'
+        # Parentheses around the aggregate functions disable the specialized aggregate loop
+        specialized_query = 'select a1, add_suffix(a1), count(*), sum(a2), max(a2), median(a2), percentile_exact(a2, 0.9), array_agg(a3) where int(a3) > 5 group by a1'
+        generic_query = 'select a1, add_suffix(a1), (count(1)), (sum(a2)), (max(a2)), (median(a2)), (percentile_exact(a2, 0.9)), (array_agg(a3)) where int(a3) > 5 group by a1'
+        expected_table = []
+        rbql.query_table(generic_query, input_table, expected_table, [], user_init_code=init_code)
+        original_batch_size = rbql_engine.input_batch_size
+        try:
+            rbql_engine.input_batch_size = 7
+            for query in [specialized_query, generic_query]:
+                output_table = []
+                rbql.query_table(query, input_table, output_table, [], user_init_code=init_code)
+                self.assertEqual(expected_table, output_table)
+        finally:
+            rbql_engine.input_batch_size = original_batch_size
+
+
+    def test_merge_partial_results(self):
+        input_table = [[str(i), str(i % 7), 'v' + str(i % 3)] for i in range(1000)]
+        input_table[700][0] = '700.5'
+        queries = ['select a2, count(*), sum(a1), min(a1), max(a1), median(a1), array_agg(a3) group by a2', 'select max(a1), count(*) where a2 == "3"', 'select distinct a3, a2', 'select distinct count a3', 'select top 5 distinct a2', 'select a2, count(*) group by a2 limit 3', 'select count(*) where a1 == "nothing"']
+        for query in queries:
+            expected_table = []
+            rbql.query(query, rbql_engine.TableIterator(input_table), rbql_engine.TableWriter(expected_table), [])
+            partial_results = []
+            for part in [input_table[:333], input_table[333:690], input_table[690:]]:
+                partial_results.append(rbql_engine.query_partial(query, rbql_engine.TableIterator(part), []))
+            output_table = []
+            rbql_engine.write_partial_result(rbql_engine.merge_partial_results(partial_results), rbql_engine.TableWriter(output_table))
+            self.assertEqual(expected_table, output_table, 'Query: {}'.format(query))
+
+        partial_results = [rbql_engine.query_partial('select a1, a2, count(*) group by a1', rbql_engine.TableIterator(part), []) for part in [[['k', 'x']], [['k', 'y']]]]
+        with self.assertRaises(rbql_engine.RbqlRuntimeError) as cm:
+            rbql_engine.merge_partial_results(partial_results)
+        self.assertTrue(str(cm.exception).find('non-constant values in output column 2') != -1)
+
+        self.assertTrue(rbql_engine.get_parallel_query_info('select a2, array_agg(a1, lambda v: ",".join(v)) group by a2') is None)
+        self.assertTrue(rbql_engine.get_parallel_query_info('select a2, ARRAY_AGG(a1), max(a1, key=len) group by a2')['merge_results'])
+
+
 class TestRBQLWithCSV(unittest.TestCase):
 
     def process_test_case(self, tmp_tests_dir, test_case):
@@ -909,6 +1411,85 @@ class TestRBQLWithCSV(unittest.TestCase):
 
 
 
+    def test_compressed_tables(self):
+        import gzip
+        import bz2
+        tmp_tests_dir = tempfile.mkdtemp(prefix='rbql_compressed_tables_')
+        try:
+            input_path = os.path.join(tmp_tests_dir, 'input.csv.gz')
+            join_path = os.path.join(tmp_tests_dir, 'join.csv.bz2')
+            plain_path = os.path.join(tmp_tests_dir, 'plain.csv.gz') # Misleading extension, the file is not compressed
+            output_path = os.path.join(tmp_tests_dir, 'output.csv.gz')
+            with gzip.open(input_path, 'wb') as dst:
+                dst.write('1,hello\n2,"world, again"\n3,foo\n'.encode('utf-8'))
+            with bz2.BZ2File(join_path, 'wb') as dst:
+                dst.write('1,a\n3,c\n'.encode('utf-8'))
+            with open(plain_path, 'wb') as dst:
+                dst.write('1,a\n3,c\n'.encode('utf-8'))
+            for join_table_path in [join_path, plain_path]:
+                warnings = []
+                rbql_csv.query_csv('select a2, b2 join {} on a1 == b1'.format(join_table_path), input_path, ',', 'quoted', output_path, ',', 'quoted', 'utf-8', warnings, with_headers=False)
+                self.assertEqual([], warnings)
+                with gzip.open(output_path, 'rb') as src:
+                    self.assertEqual('hello,a\nfoo,c\n', src.read().decode('utf-8'))
+        finally:
+            shutil.rmtree(tmp_tests_dir)
+
+
+    def test_parallel_query(self):
+        import gzip
+        tmp_tests_dir = tempfile.mkdtemp(prefix='rbql_parallel_query_')
+        saved_min_part_size = rbql_csv.min_parallel_part_size
+        rbql_csv.min_parallel_part_size = 100
+        try:
+            table = [['id', 'name', 'text']] + [[str(i), 'n' + str(i % 7), random.choice(['plain', 'multi\nline, "quoted"', 'a,b', ''])] for i in xrange6(500)]
+            table[300].append('extra')
+            input_path = os.path.join(tmp_tests_dir, 'input.csv')
+            with open(input_path, 'wb') as dst:
+                # Files with old Mac "\r" line separators can't be split into parts, they are always processed by a single process
+                dst.write('\n'.join([random_smart_join(row, ',', 'quoted_rfc') for row in table]).encode('utf-8'))
+            queries = ['select NR, a1, a3 where a1.endswith("7")', 'select * with (header)', 'update set a2 = a2 + "!" where NR % 3 == 0', 'select a.name, NR with (header)']
+            queries += ['select a.name, count(*), max(NR), sum(a.id), array_agg(a.text) group by a.name with (header)', 'select distinct a.text with (header)', 'select top 2 distinct count a.name', 'select count(*) where a1 == "nothing"']
+            def run_parallel(query, input_path):
+                warnings = []
+                with open(output_path, 'wb') as output_stream:
+                    is_parallel = rbql_csv.try_query_csv_in_parallel(3, query, input_path, ',', 'quoted_rfc', output_stream, ',', 'quoted_rfc', 'utf-8', warnings, False, None, '', False)
+                with open(output_path, 'rb') as src:
+                    return (is_parallel, src.read(), warnings)
+            output_path = os.path.join(tmp_tests_dir, 'output.csv')
+            for query in queries:
+                warnings = []
+                try:
+                    rbql_csv.query_csv(query, input_path, ',', 'quoted_rfc', output_path, ',', 'quoted_rfc', 'utf-8', warnings, with_headers=False)
+                except rbql_engine.RbqlRuntimeError:
+                    # E.g. the "select *" query fails at the record with an extra field, then the regular execution must report the error
+                    self.assertFalse(run_parallel(query, input_path)[0], 'Query: {}'.format(query))
+                    continue
+                with open(output_path, 'rb') as src:
+                    expected_output = (True, src.read(), warnings)
+                self.assertEqual(expected_output, run_parallel(query, input_path), 'Query: {}'.format(query))
+            # These queries are executed by the regular single-process code
+            self.assertFalse(run_parallel('select * order by a1', input_path)[0])
+            self.assertFalse(run_parallel('select a.name, array_agg(a.id, lambda v: "|".join(v)) group by a.name with (header)', input_path)[0])
+            compressed_input_path = os.path.join(tmp_tests_dir, 'input.csv.gz')
+            with open(input_path, 'rb') as src, gzip.open(compressed_input_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            self.assertFalse(run_parallel('select NR, a1, a3 where a1.endswith("7")', compressed_input_path)[0])
+            rbql_csv.query_csv('select NR, a1, a3 where a1.endswith("7")', compressed_input_path, ',', 'quoted_rfc', output_path, ',', 'quoted_rfc', 'utf-8', [], with_headers=False, num_workers=3)
+            with open(output_path, 'rb') as src:
+                self.assertEqual(run_parallel('select NR, a1, a3 where a1.endswith("7")', input_path)[1], src.read())
+            byte_ranges = rbql_csv.split_file_into_parts(input_path, 10, 'quoted_rfc')
+            self.assertTrue(len(byte_ranges) > 1)
+            parsed_table = []
+            for byte_range in byte_ranges:
+                with open(input_path, 'rb') as src:
+                    parsed_table += rbql_csv.CSVRecordIterator(src, 'utf-8', ',', 'quoted_rfc', byte_range=byte_range).get_all_records()
+            self.assertEqual(len(table), len(parsed_table))
+        finally:
+            rbql_csv.min_parallel_part_size = saved_min_part_size
+            shutil.rmtree(tmp_tests_dir)
+
+
     def test_json_scenarios(self):
         tests_file = os.path.join(script_dir, 'csv_unit_tests.json')
         tmp_dir = tempfile.gettempdir()